@@ -1,17 +1,34 @@
-from pathlib import Path
-from typing import List
+import time
+from typing import Callable, List, Optional
 
-from .markov import Chain, ChainBuilder, Completer
-from .markov.text import FileText, LineTexts
+from .loader import (GENERATION_TIMEOUT, MAX_TOKENS, TOKENIZER_CACHE_SIZE,
+                     load_chain)
+from .markov import (BackoffModel, CompletionIndex, Completer, FrozenChain,
+                     Reachability, Vocabulary)
 from .markov.tokenize import Tokenizer
 
+try:
+    import readline
+except ImportError:
+    readline = None  # type: ignore
+
 
 def main():
-    chain = build_chain()
+    chain = FrozenChain(load_chain())
     print()
 
-    completer = Completer(chain)
-    tokenizer = Tokenizer()
+    reachability = None
+    if REACHABILITY:
+        reachability = Reachability(BackoffModel(chain), Completer.ENDINGS)
+    completer = Completer(chain, reachability=reachability)
+    vocab = chain.vocab()
+    tokenizer = Tokenizer(cache_size=TOKENIZER_CACHE_SIZE)
+
+    if readline is not None:
+        readline.set_completer_delims(' \t\n')
+        readline.set_completer(typeahead(CompletionIndex(chain), tokenizer,
+                                         vocab))
+        readline.parse_and_bind('tab: complete')
 
     while True:
         print('> ', end='')
@@ -20,35 +37,42 @@ def main():
         except KeyboardInterrupt:
             break
 
-        prefix = tuple(t for t in tokenizer.tokenize(prefix_input) if t != '')
+        prompt = [t for t in tokenizer.tokenize(prefix_input) if t != '']
+        prefix = vocab.encode(prompt)
 
-        try:
-            sent_tokens = [*prefix, *completer.sentence(prefix)]
-        except KeyboardInterrupt:
-            print()
-            continue
-        sent = tokenizer.detokenize(sent_tokens)
+        completion = completer.sentence(
+            prefix, max_tokens=MAX_TOKENS,
+            deadline=time.monotonic() + GENERATION_TIMEOUT)
+        sent = tokenizer.detokenize([*prompt, *vocab.decode(completion)])
         print(sent)
 
 
-def build_chain() -> Chain:
-    builder = ChainBuilder(max_state_size=3)
-    for p in corpus_filepaths():
-        print('Loading {}...'.format(p.name))
-        with open(p, 'r') as f:
-            for text in LineTexts(FileText(f)).texts():
-                builder.add(text)
+# Whether completions avoid contexts that cannot reach a sentence ending.
+# Off by default: the analysis copies the chain into a backoff model and
+# slows startup, and the bundled corpus has no such contexts.
+REACHABILITY = False
 
-    return builder.finish()
+# Number of words offered for each typeahead completion.
+TYPEAHEAD_SIZE = 20
 
 
-def corpus_filepaths() -> List[Path]:
-    corpus_dir = __here().joinpath('corpus')
-    return [p for p in corpus_dir.iterdir() if p.is_file()]
+def typeahead(index: CompletionIndex, tokenizer: Tokenizer,
+              vocab: Vocabulary) -> Callable[[str, int], Optional[str]]:
+    """
+    Return a readline completer that offers the words starting with the word
+    being typed, those that follow the words before it in the chain first.
+    """
+    matches: List[str] = []
 
+    def complete(text: str, state: int) -> Optional[str]:
+        if state == 0:
+            line = readline.get_line_buffer()[:readline.get_begidx()]
+            tokens = [t for t in tokenizer.tokenize(line) if t != '']
+            matches[:] = index.complete(vocab.encode(tokens), text,
+                                        TYPEAHEAD_SIZE)
+        return matches[state] if state < len(matches) else None
 
-def __here() -> Path:
-    return Path(__file__).parent.absolute()
+    return complete
 
 
 if __name__ == '__main__':
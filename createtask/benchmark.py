@@ -0,0 +1,361 @@
+"""
+Benchmarks for the Markov pipeline.
+
+    python -m createtask.benchmark run [--corpus synthetic|real] [--lines N]
+                                       [--sentences N] [--output FILE]
+                                       [--profile FILE]
+    python -m createtask.benchmark conformance [--fuzz N]
+
+run times tokenization, chain building into a Chain and a TrieChain, chain
+insertion, sentence generation with and without a backoff model, lockstep
+generation over NumPy arrays if NumPy is installed and perplexity
+evaluation, and writes the results as JSON. With --profile, it also writes
+the counters and timers of a profiled build and generation run. The
+results go to cache/bench_output.json next to this module unless --output
+names another file.
+conformance checks the single-pass tokenizer against the reference
+implementation.
+"""
+
+import json
+import platform
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from random import Random
+from typing import Callable, Dict, List, Tuple
+
+from .loader import corpus_filepaths
+from .markov import (ArrayChain, BackoffModel, Chain, ChainBuilder,
+                     Completer, Evaluator, FrozenChain, Profile, TrieChain)
+from .markov.memory import peak_rss
+from .markov.text import FileText
+from .markov.tokenize import Tokenizer
+
+# Fragments for generated lines, weighted towards characters that tokenizer
+# rules act on.
+FUZZ_ALPHABET = [
+    'a', 'b', '1', ' ', ' ', '.', ',', ':', ';', '"', "'", '`', '(', ')', '-',
+    '?', '!', '$', '[', ']', '>', '{', '}', '\t', '...', '--', '``', "''",
+    'word', 'a. ', "a'b", '."', '.)',
+]
+
+SYNTHETIC_PUNCTUATION = [',', ',', ';', ':', ' --']
+SYNTHETIC_ENDINGS = ['.', '.', '.', '?', '!']
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Markov pipeline benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='time the pipeline phases')
+    run.add_argument('--corpus', choices=['synthetic', 'real'],
+                     default='synthetic')
+    run.add_argument('--lines', type=int, default=20000,
+                     help='corpus lines; real corpora are repeated or cut '
+                          'to this many lines')
+    run.add_argument('--vocab', type=int, default=5000,
+                     help='synthetic vocabulary size')
+    run.add_argument('--sentences', type=int, default=2000)
+    run.add_argument('--max-state-size', type=int, default=3)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', type=Path, default=output_filepath(),
+                     metavar='FILE')
+    run.add_argument('--profile', default=None, metavar='FILE',
+                     help='also profile building and generation into FILE')
+
+    conformance = commands.add_parser(
+        'conformance', help='check the single-pass tokenizer')
+    conformance.add_argument('--fuzz', type=int, default=100000,
+                             help='number of generated lines to check')
+    conformance.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmarks(args)
+    else:
+        run_conformance(args)
+
+
+def run_benchmarks(args: Namespace) -> None:
+    rand = Random(args.seed)
+    if args.corpus == 'real':
+        lines = repeat_lines(corpus_lines(), args.lines)
+    else:
+        lines = synthetic_lines(args.lines, args.vocab, rand)
+    if len(lines) == 0:
+        print('No corpus lines to benchmark')
+        sys.exit(1)
+
+    phases: Dict[str, Dict] = dict()
+
+    tokenizer = Tokenizer()
+    tokens, elapsed = timed(lambda: [tokenizer.tokenize(line)
+                                     for line in lines])
+    token_count = sum(len(t) for t in tokens)
+    phases['tokenize'] = phase(elapsed, token_count, 'tokens')
+
+    chain = Chain()
+    builder = ChainBuilder(max_state_size=args.max_state_size, store=chain)
+    _, elapsed = timed(lambda: builder.add_lines(lines))
+    phases['add'] = phase(elapsed, token_count, 'tokens')
+
+    builder = ChainBuilder(max_state_size=args.max_state_size,
+                           store=TrieChain())
+    _, elapsed = timed(lambda: builder.add_lines(lines))
+    phases['add_trie'] = phase(elapsed, token_count, 'tokens')
+
+    ngrams = chain_ngrams(tokens, chain, args.max_state_size)
+    _, elapsed = timed(lambda: insert_all(ngrams))
+    phases['insert'] = phase(elapsed, len(ngrams), 'inserts')
+
+    frozen, elapsed = timed(lambda: FrozenChain(chain))
+    prefix_count = sum(len(chain.prefixes(state_size))
+                       for state_size in chain.state_sizes())
+    phases['freeze'] = phase(elapsed, prefix_count, 'prefixes')
+
+    completer = Completer(frozen, rand=Random(args.seed))
+    sentences, elapsed = timed(lambda: [completer.sentence()
+                                        for _ in range(0, args.sentences)])
+    generated = sum(len(s) for s in sentences)
+    phases['sentences'] = phase(elapsed, len(sentences), 'sentences')
+    phases['sentences']['tokens'] = generated
+
+    backoff, elapsed = timed(lambda: BackoffModel(frozen))
+    phases['backoff'] = phase(elapsed, len(backoff), 'contexts')
+
+    completer = Completer(frozen, rand=Random(args.seed), backoff=backoff)
+    backoff_sentences, elapsed = timed(
+        lambda: [completer.sentence() for _ in range(0, args.sentences)])
+    phases['backoff_sentences'] = phase(elapsed, len(backoff_sentences),
+                                        'sentences')
+    phases['backoff_sentences']['tokens'] = sum(len(s)
+                                                for s in backoff_sentences)
+
+    # Lockstep generation needs NumPy; leave its phases out without it.
+    try:
+        arrays, elapsed = timed(lambda: ArrayChain(frozen))
+    except ImportError:
+        arrays = None
+    if arrays is not None:
+        phases['arrays'] = phase(elapsed, len(arrays.suffixes), 'suffixes')
+
+        completer = Completer(arrays, rand=Random(args.seed))
+        lockstep, elapsed = timed(lambda: completer.generate_lockstep(
+            [()], args.sentences, seed=args.seed)[0])
+        phases['lockstep'] = phase(elapsed, len(lockstep), 'sentences')
+        phases['lockstep']['tokens'] = sum(len(s) for s in lockstep)
+
+    evaluator = Evaluator(BackoffModel(frozen, interpolated=True), tokenizer)
+    evaluation, elapsed = timed(lambda: evaluator.evaluate(lines))
+    phases['evaluate'] = phase(elapsed, evaluation.tokens, 'tokens')
+    phases['evaluate']['perplexity'] = evaluation.perplexity()
+
+    vocab = frozen.vocab()
+    _, elapsed = timed(lambda: [tokenizer.detokenize(vocab.decode(s))
+                                for s in sentences])
+    phases['detokenize'] = phase(elapsed, len(sentences), 'sentences')
+
+    report = {
+        'config': {
+            'corpus': args.corpus,
+            'lines': len(lines),
+            'vocab': args.vocab if args.corpus == 'synthetic' else None,
+            'sentences': args.sentences,
+            'max_state_size': args.max_state_size,
+            'seed': args.seed,
+            'python': platform.python_version(),
+        },
+        'phases': phases,
+        'peak_rss': peak_rss(),
+    }
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in phases.items():
+        print('{:>17}: {:8.3f}s {:12.0f} {}/s'.format(
+            name, result['seconds'], result['per_second'],
+            result['unit']))
+    print('Wrote {}'.format(args.output))
+
+    if args.profile is not None:
+        profile = profile_pipeline(lines, args)
+        with open(args.profile, 'w') as f:
+            profile.dump(f)
+        print(profile)
+        print('Wrote {}'.format(args.profile))
+
+
+def run_conformance(args: Namespace) -> None:
+    lines = corpus_lines()
+    fuzz = fuzz_lines(args.fuzz, Random(args.seed))
+
+    mismatches = check_conformance(lines + fuzz)
+    for line, expected, actual in mismatches[:20]:
+        print('Mismatch for {!r}:\n  reference {}\n  scan      {}'.format(
+            line, expected, actual))
+    print('Conformance: {} mismatches in {} corpus and {} generated lines'
+          .format(len(mismatches), len(lines), len(fuzz)))
+
+    if len(lines) != 0:
+        for name, single_pass in [('reference', False), ('scan', True)]:
+            tokenize = Tokenizer(single_pass=single_pass).tokenize
+            elapsed = time_lines(tokenize, lines, 5)
+            print('{:>9}: {:.2f} us/line, {:.0f} lines/s'.format(
+                name, elapsed / len(lines) * 1e6, len(lines) / elapsed))
+
+    if len(mismatches) != 0:
+        sys.exit(1)
+
+
+def profile_pipeline(lines: List[str], args: Namespace) -> Profile:
+    """
+    Build a chain and generate sentences from it with profiling enabled,
+    timing detokenization as well.
+    """
+    profile = Profile()
+    tokenizer = Tokenizer()
+    builder = ChainBuilder(max_state_size=args.max_state_size,
+                           tokenizer=tokenizer, store=Chain(),
+                           profile=profile)
+    frozen = FrozenChain(builder.add_lines(lines).finish())
+
+    completer = Completer(frozen, rand=Random(args.seed), profile=profile)
+    vocab = frozen.vocab()
+    for _ in range(0, args.sentences):
+        sent = completer.sentence()
+        with profile.timer('detokenize'):
+            tokenizer.detokenize(vocab.decode(sent))
+    return profile
+
+
+def phase(seconds: float, items: int, unit: str) -> Dict:
+    return {
+        'seconds': seconds,
+        'items': items,
+        'unit': unit,
+        'per_second': items / seconds if seconds > 0 else 0.0,
+        'peak_rss': peak_rss(),
+    }
+
+
+def timed(f: Callable) -> Tuple:
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start
+
+
+def chain_ngrams(tokens: List[List[str]], chain: Chain,
+                 max_state_size: int) -> List[Tuple]:
+    """
+    Return the (prefix, suffix) insertions that building the chain made, so
+    Chain.insert can be timed on its own.
+    """
+    intern = chain.vocab().intern
+    ngrams: List[Tuple[Tuple[int, ...], int]] = []
+    for line_tokens in tokens:
+        history: List[int] = []
+        for token in line_tokens:
+            if token == '':
+                continue
+            unit = intern(token)
+            if len(history) == 0:
+                ngrams.append(((), unit))
+            for state_size in range(1, len(history) + 1):
+                ngrams.append((tuple(history[-state_size:]), unit))
+            history.append(unit)
+            if len(history) > max_state_size:
+                del history[0]
+    return ngrams
+
+
+def insert_all(ngrams: List[Tuple]) -> Chain:
+    chain = Chain()
+    insert = chain.insert
+    for prefix, suffix in ngrams:
+        insert(prefix, suffix)
+    return chain
+
+
+def check_conformance(lines: List[str]) -> List[tuple]:
+    """
+    Tokenize every line with both engines and return the lines whose non-empty
+    tokens differ, with the reference and single-pass tokens.
+    """
+    reference = Tokenizer(single_pass=False)
+    scan = Tokenizer(single_pass=True)
+
+    mismatches = []
+    for line in lines:
+        expected = [t for t in reference.tokenize(line) if t != '']
+        actual = scan.tokenize(line)
+        if expected != actual:
+            mismatches.append((line, expected, actual))
+    return mismatches
+
+
+def time_lines(f: Callable[[str], object], lines: List[str],
+               repeat: int) -> float:
+    """
+    Return the fastest time of repeat runs of f over all lines.
+    """
+    best = float('inf')
+    for _ in range(0, repeat):
+        start = time.perf_counter()
+        for line in lines:
+            f(line)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def corpus_lines() -> List[str]:
+    lines: List[str] = []
+    for p in corpus_filepaths():
+        with open(p, 'r') as f:
+            lines.extend(line for line in FileText(f).lines() if line != '')
+    return lines
+
+
+def output_filepath() -> Path:
+    return Path(__file__).parent.absolute().joinpath('cache',
+                                                     'bench_output.json')
+
+
+def repeat_lines(lines: List[str], n: int) -> List[str]:
+    if len(lines) == 0:
+        return []
+    return [lines[i % len(lines)] for i in range(0, n)]
+
+
+def synthetic_lines(n: int, vocab_size: int, rand: Random) -> List[str]:
+    """
+    Generate n lines of one or two sentences each, with words drawn from a
+    Zipf-like distribution over vocab_size made-up words.
+    """
+    words = ['w{}'.format(i) for i in range(0, vocab_size)]
+    weights = [1 / (i + 1) for i in range(0, vocab_size)]
+
+    lines: List[str] = []
+    for _ in range(0, n):
+        sentences = []
+        for _ in range(0, rand.randint(1, 2)):
+            length = rand.randint(4, 20)
+            sent = rand.choices(words, weights=weights, k=length)
+            sent[0] = sent[0].capitalize()
+            if length > 8 and rand.random() < 0.5:
+                sent[length // 2] += rand.choice(SYNTHETIC_PUNCTUATION)
+            sentences.append(' '.join(sent) + rand.choice(SYNTHETIC_ENDINGS))
+        lines.append(' '.join(sentences))
+    return lines
+
+
+def fuzz_lines(n: int, rand: Random) -> List[str]:
+    return [''.join(rand.choice(FUZZ_ALPHABET)
+                    for _ in range(0, rand.randint(0, 12)))
+            for _ in range(0, n)]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Corpus loading and the chain cache shared by the REPL, the server and the
+benchmarks.
+
+The chain is built from the files in corpus/ and cached as a snapshot in
+cache/, with the chain and the cleaned lines of every corpus file cached
+under its content hash, so changed corpora are updated incrementally.
+"""
+
+import hashlib
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .markov import (Chain, ParallelChainBuilder, Preprocessor, Snapshot,
+                     SnapshotError)
+
+MAX_STATE_SIZE = 3
+TOKENIZER_CACHE_SIZE = 65536
+
+# Normalizes corpus files and drops duplicate lines before chain building.
+PREPROCESSOR = Preprocessor(dedup=Preprocessor.EXACT)
+
+# Bounds on a single completion, in tokens and seconds.
+MAX_TOKENS = 200
+GENERATION_TIMEOUT = 1.0
+
+
+def load_chain() -> Chain:
+    """
+    Load the chain from the cached snapshot if the corpus has not changed since
+    it was written. Otherwise update it with the files that were added,
+    changed or removed, or rebuild it if it cannot be updated, and refresh the
+    snapshot.
+    """
+    fingerprint = corpus_fingerprint()
+    snapshot_path = snapshot_filepath()
+
+    snapshot = None
+    try:
+        with open(snapshot_path, 'rb') as f:
+            snapshot = Snapshot.read(f)
+    except (IOError, SnapshotError, ValueError):
+        pass
+
+    metadata = snapshot.metadata if snapshot is not None else dict()
+    if snapshot is not None and metadata.get('fingerprint') == fingerprint:
+        print('Loaded cached chain from {}'.format(snapshot_path.name))
+        return snapshot.chain
+
+    sources = corpus_sources()
+    chain = None
+    if snapshot is not None and \
+            metadata.get('max_state_size') == MAX_STATE_SIZE and \
+            metadata.get('preprocess') == PREPROCESSOR.key() and \
+            'sources' in metadata:
+        chain = update_chain(snapshot.chain, metadata['sources'], sources)
+    if chain is None:
+        chain = build_chain(sources)
+
+    remove_stale_sources(sources)
+    write_snapshot(snapshot_path, chain, {
+        'fingerprint': fingerprint,
+        'max_state_size': MAX_STATE_SIZE,
+        'preprocess': PREPROCESSOR.key(),
+        'sources': sources,
+    })
+
+    return chain
+
+
+def build_chain(sources: Optional[Dict[str, str]] = None) -> Chain:
+    """
+    Build the chain from every corpus file. If sources maps file names to
+    content hashes, the chain of each file is also cached under its hash for
+    later updates.
+    """
+    paths = corpus_filepaths()
+    for p in paths:
+        print('Loading {}...'.format(p.name))
+
+    digests = sources if sources is not None else corpus_sources()
+    chain = Chain()
+    for path, partial in zip(paths, file_chains(paths, digests)):
+        if sources is not None:
+            write_snapshot(source_filepath(sources[path.name]), partial,
+                           {'source': path.name})
+        chain.merge(partial)
+    return chain
+
+
+def update_chain(chain: Chain, old: Dict[str, str],
+                 new: Dict[str, str]) -> Optional[Chain]:
+    """
+    Update a chain built from the old sources to the new ones, subtracting the
+    cached chains of removed and changed files and adding chains built from
+    new and changed files. Return None if a cached chain is missing.
+    """
+    removed = []
+    for name, digest in sorted(old.items()):
+        if new.get(name) == digest:
+            continue
+        try:
+            with open(source_filepath(digest), 'rb') as f:
+                removed.append((name, Snapshot.read(f).chain))
+        except (IOError, SnapshotError, ValueError):
+            return None
+
+    for name, partial in removed:
+        print('Removing {}...'.format(name))
+        chain.subtract(partial)
+
+    added = [p for p in corpus_filepaths() if old.get(p.name) != new[p.name]]
+    for p in added:
+        print('Loading {}...'.format(p.name))
+    for path, partial in zip(added, file_chains(added, new)):
+        write_snapshot(source_filepath(new[path.name]), partial,
+                       {'source': path.name})
+        chain.merge(partial)
+
+    return chain
+
+
+def file_chains(paths: List[Path], sources: Dict[str, str]) -> List[Chain]:
+    """
+    Build the chain of each corpus file from its cleaned shards, cleaning the
+    files whose shards are not cached under their content hash yet.
+    """
+    shards = PREPROCESSOR.clean_files(
+        paths, [cleaned_dirpath(sources[p.name]) for p in paths])
+
+    builder = ParallelChainBuilder(max_state_size=MAX_STATE_SIZE,
+                                   cache_size=TOKENIZER_CACHE_SIZE,
+                                   clean=False)
+    partials = iter(builder.file_chains(
+        [shard for file_shards in shards for shard in file_shards]))
+
+    chains = []
+    for file_shards in shards:
+        chain = Chain()
+        for _ in file_shards:
+            chain.merge(next(partials))
+        chains.append(chain)
+    return chains
+
+
+def write_snapshot(path: Path, chain: Chain, metadata: Dict) -> None:
+    """
+    Write a snapshot atomically, through a temporary file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+        Snapshot(chain, metadata).write(f)
+    tmp_path.replace(path)
+
+
+def remove_stale_sources(sources: Dict[str, str]) -> None:
+    """
+    Delete cached file chains and cleaned files whose contents are no longer
+    in the corpus, or were cleaned differently.
+    """
+    current = {source_filepath(digest) for digest in sources.values()}
+    sources_dir = snapshot_filepath().parent.joinpath('sources')
+    if sources_dir.is_dir():
+        for p in sources_dir.iterdir():
+            if p not in current:
+                p.unlink()
+
+    current = {cleaned_dirpath(digest) for digest in sources.values()}
+    cleaned_dir = snapshot_filepath().parent.joinpath('cleaned')
+    if cleaned_dir.is_dir():
+        for p in cleaned_dir.iterdir():
+            if p not in current:
+                shutil.rmtree(p)
+
+
+def corpus_filepaths() -> List[Path]:
+    corpus_dir = __here().joinpath('corpus')
+    return [p for p in corpus_dir.iterdir() if p.is_file()]
+
+
+def corpus_fingerprint() -> Dict:
+    files = []
+    for p in sorted(corpus_filepaths()):
+        stat = p.stat()
+        files.append([p.name, stat.st_size, stat.st_mtime_ns])
+    return {'max_state_size': MAX_STATE_SIZE,
+            'preprocess': PREPROCESSOR.key(), 'files': files}
+
+
+def corpus_sources() -> Dict[str, str]:
+    """
+    Return the SHA-256 digest of every corpus file by name.
+    """
+    sources = dict()
+    for p in sorted(corpus_filepaths()):
+        digest = hashlib.sha256()
+        with open(p, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        sources[p.name] = digest.hexdigest()
+    return sources
+
+
+def snapshot_filepath() -> Path:
+    return __here().joinpath('cache', 'chain.snapshot')
+
+
+def source_filepath(digest: str) -> Path:
+    return __here().joinpath('cache', 'sources', digest + '.snapshot')
+
+
+def cleaned_dirpath(digest: str) -> Path:
+    return __here().joinpath('cache', 'cleaned',
+                             '{}-{}'.format(digest, PREPROCESSOR.key()))
+
+
+def __here() -> Path:
+    return Path(__file__).parent.absolute()
@@ -1,2 +1,21 @@
-from .chain import Chain, ChainBuilder
+from .arrays import ArrayChain
+from .autocomplete import CompletionIndex
+from .backoff import BackoffModel
+from .chain import (Chain, ChainBuilder, ChainStore, ChainView,
+                    IngestProgress, PruneStats, SamplingTable)
 from .completer import Completer
+from .evaluate import Evaluation, Evaluator
+from .frozen import FrozenChain
+from .parallel import ParallelChainBuilder
+from .preprocess import (Normalizer, Preprocessor, RegexNormalizer,
+                         StripNormalizer, UnicodeNormalizer,
+                         WhitespaceNormalizer)
+from .profile import Profile
+from .reach import Reachability
+from .sampling import (GreedySampler, NucleusSampler, Sampler,
+                       TemperatureSampler, TopKSampler, WeightedSampler)
+from .sketch import CountMinSketch
+from .snapshot import LazyChain, MappedChain, Snapshot, SnapshotError
+from .tokenize import Tokenizer
+from .trie import TrieChain
+from .vocab import Vocabulary
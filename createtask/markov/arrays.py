@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import time
+from itertools import chain as concat
+from typing import Collection, List, Optional
+
+from .backoff import NO_CONTEXT, BackoffModel
+from .chain import ChainView, Prefix, SamplingTable, Suffix, SuffixData
+from .vocab import Vocabulary
+
+
+class ArrayChain(ChainView):
+    """
+    Read-only chain compiled into NumPy arrays, for generating many sequences
+    in lockstep. Prefixes are numbered as contexts of a BackoffModel, and the
+    suffixes of all contexts are laid out in CSR form: the suffixes of context
+    i are at offsets[i]:offsets[i + 1] of suffixes, with the contexts that
+    follow them in following. cum_counts holds the running total of all counts
+    across every context, so one searchsorted over it samples a suffix for a
+    whole batch of contexts at once.
+
+    Requires NumPy, which is imported on first use so that importing the
+    package does not load it.
+    """
+
+    def __init__(self, chain: ChainView,
+                 max_state_size: Optional[int] = None) -> None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('ArrayChain requires NumPy')
+
+        model = BackoffModel(chain, max_state_size)
+        self.__model = model
+
+        contexts = range(0, len(model))
+        tables = [model.table_of(context) for context in contexts]
+        sizes = numpy.fromiter((len(t.suffixes) for t in tables),
+                               dtype=numpy.int64, count=len(tables))
+        self.offsets = numpy.zeros(len(tables) + 1, dtype=numpy.int64)
+        numpy.cumsum(sizes, out=self.offsets[1:])
+
+        entries = int(self.offsets[-1])
+        self.suffixes = numpy.fromiter(
+            concat.from_iterable(t.suffixes for t in tables),
+            dtype=numpy.int64, count=entries)
+        self.following = numpy.fromiter(
+            concat.from_iterable(model.next_of(context)
+                                 for context in contexts),
+            dtype=numpy.int64, count=entries)
+
+        counts = numpy.fromiter(
+            concat.from_iterable(t.counts().values() for t in tables),
+            dtype=numpy.float64, count=entries)
+        self.cum_counts = numpy.cumsum(counts)
+
+        # Running total before each context, and each context's own total.
+        ends = numpy.concatenate(([0.0], self.cum_counts))
+        self.bases = ends[self.offsets[:-1]]
+        self.totals = ends[self.offsets[1:]] - self.bases
+
+    def prefixes(self, state_size: int) -> List[Prefix]:
+        model = self.__model
+        prefixes = [model.prefix_of(context)
+                    for context in range(0, len(model))
+                    if len(model.prefix_of(context)) == state_size]
+        if len(prefixes) == 0:
+            raise KeyError(state_size)
+        return prefixes
+
+    def suffixes_of(self, prefix: Prefix) -> Optional[SuffixData]:
+        table = self.sampling_table(prefix)
+        if table is None:
+            return None
+        return table.counts()
+
+    def state_sizes(self) -> List[int]:
+        model = self.__model
+        return sorted({len(model.prefix_of(context))
+                       for context in range(0, len(model))})
+
+    def vocab(self) -> Vocabulary:
+        return self.__model.vocab()
+
+    def sampling_table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        model = self.__model
+        context = model.context_of(prefix)
+        if context == NO_CONTEXT or model.prefix_of(context) != prefix:
+            return None
+        return model.table_of(context)
+
+    def generate(self, prefixes: List[Prefix], endings: Collection[Suffix],
+                 min_n: int = 1, min_c: int = 0, max_tokens: int = 200,
+                 deadline: Optional[float] = None,
+                 seed: Optional[int] = None) -> List[List[Suffix]]:
+        """
+        Complete every prefix at once, as Completer.sentences would with a
+        backoff model: a completion stops after more than min_n tokens in
+        endings once more than min_c tokens are generated, when its context
+        runs out, after max_tokens tokens, or once time.monotonic() reaches
+        deadline. Each step samples the next token of every unfinished
+        completion with one searchsorted over cum_counts.
+        """
+        import numpy
+
+        model = self.__model
+        rng = numpy.random.default_rng(seed)
+
+        is_ending = numpy.zeros(len(model.vocab()) + 1, dtype=bool)
+        is_ending[[e for e in endings if e >= 0]] = True
+
+        batch = len(prefixes)
+        contexts = numpy.fromiter((model.context_of(p) for p in prefixes),
+                                  dtype=numpy.int64, count=batch)
+        tokens = numpy.full((batch, max_tokens), -1, dtype=numpy.int64)
+        lengths = numpy.zeros(batch, dtype=numpy.int64)
+        ended = numpy.zeros(batch, dtype=numpy.int64)
+
+        active = numpy.flatnonzero(contexts != NO_CONTEXT)
+        for step in range(0, max_tokens):
+            if len(active) == 0:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+
+            current = contexts[active]
+            targets = self.bases[current] \
+                + rng.random(len(active)) * self.totals[current]
+            i = numpy.searchsorted(self.cum_counts, targets, side='right')
+            i = numpy.minimum(i, self.offsets[current + 1] - 1)
+
+            suffixes = self.suffixes[i]
+            tokens[active, step] = suffixes
+            lengths[active] = step + 1
+            following = self.following[i]
+            contexts[active] = following
+
+            ending = is_ending[suffixes]
+            ended[active] += ending
+            done = (following == NO_CONTEXT) | \
+                (ending & (ended[active] > min_n) & (step + 1 > min_c))
+            active = active[~done]
+
+        return [tokens[row, :lengths[row]].tolist()
+                for row in range(0, batch)]
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from heapq import nlargest
+from typing import Dict, List, Optional, Tuple
+
+from .chain import ChainView, Prefix, SamplingTable
+from .sampling import ranked
+
+
+class CompletionIndex:
+    """
+    Lookups for typeahead over a chain. Every token that follows a prefix of
+    the chain is kept in a sorted list with its count, the number of times it
+    follows a single-token prefix, so the tokens starting with a partial word
+    are one bisection away. Next words come from the sampling table of the
+    longest suffix of the history, at most max_state_size long, that is a
+    prefix of the chain, ranked by count as sampling.ranked does.
+
+    Short partial words match much of the vocabulary, so their results are
+    cached.
+    """
+
+    CACHED_PARTIAL_LENGTH = 2
+
+    def __init__(self, chain: ChainView,
+                 max_state_size: Optional[int] = None) -> None:
+        self.__chain = chain
+        if max_state_size is None:
+            max_state_size = max(chain.state_sizes(), default=0)
+        self.__max_state_size = max_state_size
+
+        vocab = chain.vocab()
+        counts: Dict[int, int] = dict()
+        state_sizes = chain.state_sizes()
+        for prefix in chain.prefixes(1) if 1 in state_sizes else []:
+            suffixes = chain.suffixes_of(prefix)
+            if suffixes is None:
+                continue
+            for suffix, count in suffixes.items():
+                counts[suffix] = counts.get(suffix, 0) + count
+
+        entries = sorted((vocab.token(suffix), count)
+                         for suffix, count in counts.items())
+        self.__tokens = [token for token, _ in entries]
+        self.__counts = [count for _, count in entries]
+        self.__cache: Dict[Tuple[str, int], List[str]] = dict()
+
+    def words(self, partial: str, n: int = 10) -> List[str]:
+        """
+        Return the n most frequent tokens that start with partial, most
+        frequent first, and in sorted order among equals.
+        """
+        cacheable = len(partial) <= self.CACHED_PARTIAL_LENGTH
+        if cacheable:
+            cached = self.__cache.get((partial, n))
+            if cached is not None:
+                return cached
+
+        tokens = self.__tokens
+        start = bisect_left(tokens, partial)
+        end = start
+        while end < len(tokens) and tokens[end].startswith(partial):
+            end += 1
+
+        counts = self.__counts
+        best = nlargest(n, range(start, end), key=lambda i: counts[i])
+        words = [tokens[i] for i in best]
+        if cacheable:
+            self.__cache[(partial, n)] = words
+        return words
+
+    def next_words(self, prefix: Prefix, n: int = 10) -> List[str]:
+        """
+        Return the n most frequent tokens to follow the history prefix of
+        token IDs, most frequent first.
+        """
+        table = self.__table(prefix)
+        if table is None:
+            return []
+        vocab = self.__chain.vocab()
+        return vocab.decode(ranked(table, 1.0).suffixes[:n])
+
+    def complete(self, prefix: Prefix, partial: str,
+                 n: int = 10) -> List[str]:
+        """
+        Return up to n tokens starting with partial for the history prefix:
+        the tokens that follow it in the chain first, by count, then the most
+        frequent other tokens.
+        """
+        table = self.__table(prefix)
+        words: List[str] = []
+        if table is not None:
+            vocab = self.__chain.vocab()
+            for suffix in ranked(table, 1.0).suffixes:
+                token = vocab.token(suffix)
+                if token.startswith(partial):
+                    words.append(token)
+                    if len(words) == n:
+                        return words
+
+        seen = set(words)
+        for word in self.words(partial, n + len(words)):
+            if word not in seen:
+                words.append(word)
+                if len(words) == n:
+                    break
+        return words
+
+    def __table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        """
+        Return the sampling table of the longest suffix of prefix that is in
+        the chain, or of the empty prefix if prefix is empty.
+        """
+        chain = self.__chain
+        if len(prefix) == 0:
+            return chain.sampling_table(())
+        for start in range(max(0, len(prefix) - self.__max_state_size),
+                           len(prefix)):
+            table = chain.sampling_table(prefix[start:])
+            if table is not None:
+                return table
+        return None
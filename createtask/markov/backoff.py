@@ -0,0 +1,392 @@
+from __future__ import annotations
+
+from random import Random
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .chain import ChainView, Prefix, SamplingTable, Suffix, SuffixData
+from .sampling import Sampler
+from .vocab import Vocabulary
+
+# Context ID for histories that have no context in the chain.
+NO_CONTEXT = -1
+
+
+class BackoffModel:
+    """
+    Precomputed backoff structure over a chain. Every prefix of the chain is a
+    context with an integer ID. Each context links to its backoff context, the
+    longest shorter suffix of it that is in the chain, and each of its suffixes
+    links to the context that follows, the longest suffix of the prefix
+    extended by that suffix that is in the chain. Generating from a context
+    then takes one sample and one lookup, instead of the repeated lookups of
+    shorter and shorter prefixes that Completer.suffix_any makes.
+
+    As with suffix_any, the empty prefix is only the context of an empty
+    history; non-empty histories never back off to it.
+
+    If interpolated is True, suffixes are drawn from an interpolated
+    Kneser-Ney distribution: every count is reduced by discount and the mass
+    taken away is given to the backoff context, down to a distribution over
+    all tokens. The context a history matches uses its counts; the contexts it
+    backs off to use continuation counts, the number of distinct tokens that
+    precede the context and suffix in the chain.
+    """
+
+    def __init__(self, chain: ChainView, max_state_size: Optional[int] = None,
+                 interpolated: bool = False, discount: float = 0.75) -> None:
+        state_sizes = chain.state_sizes()
+        if max_state_size is None:
+            max_state_size = max(state_sizes, default=0)
+        self.__max_state_size = max_state_size
+        self.__interpolated = interpolated
+        self.__vocab = chain.vocab()
+
+        self.__ids: Dict[Prefix, int] = dict()
+        self.__prefixes: List[Prefix] = []
+        self.__tables: List[SamplingTable] = []
+        for state_size in sorted(state_sizes):
+            if state_size > max_state_size:
+                continue
+            for prefix in chain.prefixes(state_size):
+                table = chain.sampling_table(prefix)
+                if table is None:
+                    continue
+                self.__ids[prefix] = len(self.__prefixes)
+                self.__prefixes.append(prefix)
+                self.__tables.append(table)
+
+        self.__backoff = [self.__longest(prefix[1:])
+                          for prefix in self.__prefixes]
+        self.__next = [tuple(self.__longest((*prefix, suffix))
+                             for suffix in table.suffixes)
+                       for prefix, table in zip(self.__prefixes,
+                                                self.__tables)]
+        self.__indices: Dict[int, Dict[Suffix, int]] = dict()
+
+        # Discounted tables of each context's counts and continuation counts,
+        # and the undiscounted totals they are drawn against.
+        self.__upper: List[SamplingTable] = []
+        self.__upper_totals: List[float] = []
+        self.__lower: List[SamplingTable] = []
+        self.__lower_totals: List[float] = []
+        self.__unigram: Optional[SamplingTable] = None
+        self.__unigram_counts: SuffixData = dict()
+        if interpolated:
+            self.__interpolate(discount)
+        self.__arrays: Optional[_ProbabilityArrays] = None
+
+    def context_of(self, prefix: Prefix) -> int:
+        """
+        Return the context to continue the history prefix from, or NO_CONTEXT
+        if the chain has none.
+        """
+        if len(prefix) == 0:
+            return self.__ids.get((), NO_CONTEXT)
+        return self.__longest(prefix)
+
+    def prefix_of(self, context: int) -> Prefix:
+        return self.__prefixes[context]
+
+    def backoff_of(self, context: int) -> int:
+        return self.__backoff[context]
+
+    def table_of(self, context: int) -> SamplingTable:
+        return self.__tables[context]
+
+    def next_of(self, context: int) -> Tuple[int, ...]:
+        """
+        Return the contexts that follow context and each of its suffixes, in
+        the order of its sampling table.
+        """
+        return self.__next[context]
+
+    def step(self, context: int, rand: Random,
+             sampler: Optional[Sampler] = None) \
+            -> Optional[Tuple[Suffix, int]]:
+        """
+        Return a random suffix of the context and the context that follows
+        it, or None if there is no context to continue from. If given, sampler
+        picks the suffix from the context's table; samplers cannot be used
+        with an interpolated model.
+        """
+        if context == NO_CONTEXT:
+            return None
+        if self.__interpolated:
+            if sampler is not None:
+                raise ValueError('Samplers need a model that is not '
+                                 'interpolated')
+            return self.__step_interpolated(context, rand)
+
+        if sampler is not None:
+            suffix = sampler.sample(self.__tables[context], rand)
+            return suffix, self.follow(context, suffix)
+
+        i = self.__tables[context].index(rand)
+        return self.__tables[context].suffixes[i], self.__next[context][i]
+
+    def follow(self, context: int, suffix: Suffix) -> int:
+        """
+        Return the context that follows context and suffix.
+        """
+        while context != NO_CONTEXT:
+            i = self.__index_of(context).get(suffix)
+            if i is not None:
+                return self.__next[context][i]
+            context = self.__backoff[context]
+        return self.__ids.get((suffix,), NO_CONTEXT)
+
+    def probability(self, context: int, suffix: Suffix) -> float:
+        """
+        Return the probability that step draws suffix from context. If the
+        model is interpolated, NO_CONTEXT gives the base distribution over all
+        tokens.
+        """
+        if not self.__interpolated:
+            if context == NO_CONTEXT:
+                return 0.0
+            i = self.__index_of(context).get(suffix)
+            if i is None:
+                return 0.0
+            return _weight(self.__tables[context], i) \
+                / self.__tables[context].total
+
+        p = 0.0
+        share = 1.0
+        tables, totals = self.__upper, self.__upper_totals
+        while context != NO_CONTEXT:
+            table, total = tables[context], totals[context]
+            i = self.__index_of(context).get(suffix)
+            if i is not None:
+                p += share * _weight(table, i) / total
+            share *= (total - table.total) / total
+            context = self.__backoff[context]
+            tables, totals = self.__lower, self.__lower_totals
+
+        unigram = self.__unigram
+        if unigram is not None:
+            p += share * self.__unigram_counts.get(suffix, 0) / unigram.total
+        return p
+
+    def probabilities(self, contexts: Sequence[int],
+                      suffixes: Sequence[Suffix]) -> Any:
+        """
+        Return a NumPy array of the probability of every suffix from the
+        context at the same position, as probability gives it. The whole
+        batch is computed with array operations, one pass per backoff level,
+        over arrays that are compiled on the first call.
+
+        Requires NumPy, which is imported on first use so that importing the
+        package does not load it.
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('BackoffModel.probabilities requires NumPy')
+
+        if self.__arrays is None:
+            self.__arrays = self.__compile()
+        arrays = self.__arrays
+
+        starts = numpy.asarray(contexts, dtype=numpy.int64)
+        tokens = numpy.asarray(suffixes, dtype=numpy.int64)
+        p = numpy.zeros(len(starts), dtype=numpy.float64)
+        share = numpy.ones(len(starts), dtype=numpy.float64)
+
+        weights, totals, left = arrays.upper
+        rows = numpy.flatnonzero(starts != NO_CONTEXT)
+        current = starts[rows]
+        while len(rows) != 0:
+            p[rows] += share[rows] * arrays.weights_of(
+                current, tokens[rows], weights) / totals[current]
+            share[rows] *= left[current]
+            if not self.__interpolated:
+                break
+
+            current = arrays.backoff[current]
+            kept = current != NO_CONTEXT
+            rows, current = rows[kept], current[kept]
+            weights, totals, left = arrays.lower
+
+        if arrays.unigram is not None:
+            p += share * arrays.unigram[tokens]
+        return p
+
+    def max_state_size(self) -> int:
+        return self.__max_state_size
+
+    def interpolated(self) -> bool:
+        return self.__interpolated
+
+    def vocab(self) -> Vocabulary:
+        return self.__vocab
+
+    def __len__(self) -> int:
+        return len(self.__prefixes)
+
+    def __longest(self, prefix: Prefix) -> int:
+        """
+        Return the longest non-empty suffix of prefix, at most max_state_size
+        long, that is a context.
+        """
+        ids = self.__ids
+        for start in range(max(0, len(prefix) - self.__max_state_size),
+                           len(prefix)):
+            context = ids.get(prefix[start:])
+            if context is not None:
+                return context
+        return NO_CONTEXT
+
+    def __index_of(self, context: int) -> Dict[Suffix, int]:
+        index = self.__indices.get(context)
+        if index is None:
+            index = {suffix: i for i, suffix
+                     in enumerate(self.__tables[context].suffixes)}
+            self.__indices[context] = index
+        return index
+
+    def __interpolate(self, discount: float) -> None:
+        # Every (token, context, suffix) in the chain adds one continuation to
+        # (context, suffix); contexts of size 1 add to the unigram level.
+        continuations: List[SuffixData] = [dict() for _ in self.__prefixes]
+        unigram: SuffixData = dict()
+        for prefix, table in zip(self.__prefixes, self.__tables):
+            if len(prefix) == 0:
+                continue
+            if len(prefix) == 1:
+                counts = unigram
+            else:
+                shorter = self.__ids.get(prefix[1:])
+                if shorter is None:
+                    continue
+                counts = continuations[shorter]
+            for suffix in table.suffixes:
+                counts[suffix] = counts.get(suffix, 0) + 1
+
+        for table, continued in zip(self.__tables, continuations):
+            counts = table.counts()
+            self.__upper.append(_discounted(counts, discount))
+            self.__upper_totals.append(table.total)
+
+            # Contexts that no longer context extends keep their own counts.
+            lower = {suffix: continued.get(suffix, 0)
+                     for suffix in table.suffixes}
+            if sum(lower.values()) == 0:
+                lower = counts
+            self.__lower.append(_discounted(lower, discount))
+            self.__lower_totals.append(sum(lower.values()))
+
+        if len(unigram) != 0:
+            self.__unigram = SamplingTable.from_counts(unigram)
+            self.__unigram_counts = unigram
+
+    def __compile(self) -> _ProbabilityArrays:
+        import numpy
+
+        contexts = range(0, len(self.__prefixes))
+        sizes = numpy.fromiter((len(t.suffixes) for t in self.__tables),
+                               dtype=numpy.int64, count=len(self.__tables))
+        suffixes = numpy.fromiter(
+            (s for t in self.__tables for s in t.suffixes),
+            dtype=numpy.int64, count=int(sizes.sum()))
+
+        # Every (context, suffix) pair is one key, sorted so that a batch of
+        # pairs is found with one searchsorted.
+        vocab_size = len(self.__vocab) + 1
+        keys = numpy.repeat(numpy.arange(len(sizes), dtype=numpy.int64),
+                            sizes) * vocab_size + suffixes
+        order = numpy.argsort(keys, kind='stable')
+
+        def level(tables: List[SamplingTable],
+                  totals: List[float]) -> Tuple[Any, Any, Any]:
+            weights = numpy.fromiter(
+                (_weight(table, i) for table in tables
+                 for i in range(0, len(table.suffixes))),
+                dtype=numpy.float64, count=len(order))
+            totals_array = numpy.array(totals, dtype=numpy.float64)
+            remaining = numpy.array([table.total for table in tables],
+                                    dtype=numpy.float64)
+            return (weights[order], totals_array,
+                    (totals_array - remaining) / totals_array)
+
+        backoff = numpy.array(self.__backoff, dtype=numpy.int64)
+        if not self.__interpolated:
+            totals = [self.__tables[context].total for context in contexts]
+            upper = level(self.__tables, totals)
+            return _ProbabilityArrays(keys[order], vocab_size, upper, upper,
+                                      backoff, None)
+
+        upper = level(self.__upper, self.__upper_totals)
+        lower = level(self.__lower, self.__lower_totals)
+        unigram = None
+        if self.__unigram is not None:
+            unigram = numpy.zeros(vocab_size, dtype=numpy.float64)
+            for suffix, count in self.__unigram_counts.items():
+                unigram[suffix] = count / self.__unigram.total
+        return _ProbabilityArrays(keys[order], vocab_size, upper, lower,
+                                  backoff, unigram)
+
+    def __step_interpolated(self, context: int,
+                            rand: Random) -> Optional[Tuple[Suffix, int]]:
+        top = context
+        tables, totals = self.__upper, self.__upper_totals
+        while context != NO_CONTEXT:
+            # Draws past the discounted weights fall to the backoff context.
+            table = tables[context]
+            weight = rand.random() * totals[context]
+            if weight < table.total:
+                suffix = table.suffixes[table.find(weight)]
+                return suffix, self.follow(top, suffix)
+            context = self.__backoff[context]
+            tables, totals = self.__lower, self.__lower_totals
+
+        unigram = self.__unigram
+        if unigram is None:
+            return None
+        suffix = unigram.suffixes[unigram.index(rand)]
+        return suffix, self.follow(top, suffix)
+
+
+class _ProbabilityArrays:
+    """
+    Arrays BackoffModel.probabilities computes with. keys holds context *
+    vocab_size + suffix for every suffix of every context, sorted; upper and
+    lower hold the weight of each key, and the total and the share left to
+    the backoff context of each context, for the context a history matches
+    and for the contexts it backs off to. unigram holds the probability of
+    every token at the base level, or is None if there is none.
+    """
+
+    def __init__(self, keys: Any, vocab_size: int,
+                 upper: Tuple[Any, Any, Any], lower: Tuple[Any, Any, Any],
+                 backoff: Any, unigram: Optional[Any]) -> None:
+        self.keys = keys
+        self.vocab_size = vocab_size
+        self.upper = upper
+        self.lower = lower
+        self.backoff = backoff
+        self.unigram = unigram
+
+    def weights_of(self, contexts: Any, suffixes: Any, weights: Any) -> Any:
+        """
+        Return the weight of every suffix in the context at the same
+        position, or 0 where the context does not have it.
+        """
+        import numpy
+
+        keys = contexts * self.vocab_size + suffixes
+        i = numpy.searchsorted(self.keys, keys)
+        i = numpy.minimum(i, len(self.keys) - 1)
+        return numpy.where(self.keys[i] == keys, weights[i], 0.0)
+
+
+def _discounted(counts: SuffixData, discount: float) -> SamplingTable:
+    cum_weights = []
+    total = 0.0
+    for count in counts.values():
+        total += max(count - discount, 0.0)
+        cum_weights.append(total)
+    return SamplingTable(tuple(counts), tuple(cum_weights))
+
+
+def _weight(table: SamplingTable, i: int) -> float:
+    return table.cum_weights[i] - (table.cum_weights[i - 1] if i > 0 else 0)
@@ -1,20 +1,156 @@
 from __future__ import annotations
 
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, Iterator, List, Optional, Tuple
-
+from bisect import bisect_right
+from random import Random
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, Tuple)
+
+from .memory import container_size, peak_rss
+from .profile import Profile
+from .sketch import CountMinSketch
 from .tokenize import Tokenizer
+from .vocab import Vocabulary
 
-Prefix = Tuple[str, ...]
-Suffix = str
+Prefix = Tuple[int, ...]
+Suffix = int
 SuffixData = Dict[Suffix, int]
 SizeGroup = Dict[Prefix, SuffixData]
 ChainDict = Dict[int, SizeGroup]
 
 
-class Chain:
-    def __init__(self):
+class ChainView(ABC):
+    """
+    Read-only interface to a chain, used by Completer.
+    """
+
+    @abstractmethod
+    def prefixes(self, state_size: int) -> List[Prefix]:
+        pass
+
+    @abstractmethod
+    def suffixes_of(self, prefix: Prefix) -> Optional[SuffixData]:
+        pass
+
+    @abstractmethod
+    def state_sizes(self) -> List[int]:
+        pass
+
+    @abstractmethod
+    def vocab(self) -> Vocabulary:
+        pass
+
+    @abstractmethod
+    def sampling_table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        """
+        Return the table to sample suffixes of the prefix from, or None if the
+        prefix is not in the chain.
+        """
+        pass
+
+
+class ChainStore(ChainView):
+    """
+    Chain that counts insertions, used by ChainBuilder.
+    """
+
+    @abstractmethod
+    def insert(self, prefix: Prefix, suffix: Suffix) -> None:
+        pass
+
+    @abstractmethod
+    def insert_history(self, history: Sequence[Suffix],
+                       suffix: Suffix) -> None:
+        """
+        Count suffix after every non-empty suffix of history, or as a start
+        token if history is empty.
+        """
+        pass
+
+
+class SamplingTable:
+    """
+    Suffixes of a prefix with their cumulative counts, for weighted sampling by
+    bisection. Tables derived by samplers and backoff models hold fractional
+    weights, so weights are typed as floats.
+    """
+
+    __slots__ = ('suffixes', 'cum_weights', 'total', 'derived')
+
+    def __init__(self, suffixes: Tuple[Suffix, ...],
+                 cum_weights: Tuple[float, ...]) -> None:
+        self.suffixes = suffixes
+        self.cum_weights = cum_weights
+        self.total: float = cum_weights[-1]
+
+        # Tables computed from this one by samplers, created on first use.
+        self.derived: Optional[Dict[object, SamplingTable]] = None
+
+    @staticmethod
+    def from_counts(suffixes: SuffixData) -> SamplingTable:
+        cum_weights = []
+        total = 0
+        for count in suffixes.values():
+            total += count
+            cum_weights.append(total)
+        return SamplingTable(tuple(suffixes), tuple(cum_weights))
+
+    def sample(self, rand: Random) -> Suffix:
+        i = bisect_right(self.cum_weights, rand.random() * self.total,
+                         0, len(self.cum_weights) - 1)
+        return self.suffixes[i]
+
+    def index(self, rand: Random) -> int:
+        """
+        Return the index of a randomly sampled suffix.
+        """
+        return self.find(rand.random() * self.total)
+
+    def find(self, weight: float) -> int:
+        """
+        Return the index of the suffix whose cumulative weight range contains
+        weight, for 0 <= weight < total.
+        """
+        return bisect_right(self.cum_weights, weight,
+                            0, len(self.cum_weights) - 1)
+
+    def derive(self, key: object,
+               compute: Callable[[SamplingTable], SamplingTable]) \
+            -> SamplingTable:
+        """
+        Return the table computed from this one by compute, computing it only
+        the first time it is asked for under key.
+        """
+        derived = self.derived
+        if derived is None:
+            derived = self.derived = dict()
+        table = derived.get(key)
+        if table is None:
+            table = derived[key] = compute(self)
+        return table
+
+    def counts(self) -> SuffixData:
+        """
+        Return the count of every suffix of a table built from counts.
+        """
+        counts = dict()
+        previous = 0.0
+        for suffix, cum_weight in zip(self.suffixes, self.cum_weights):
+            counts[suffix] = int(cum_weight - previous)
+            previous = cum_weight
+        return counts
+
+
+class Chain(ChainStore):
+    """
+    Markov chain over token IDs. Prefixes and suffixes are IDs from the chain's
+    vocabulary; use vocab() to convert to and from token strings.
+    """
+
+    def __init__(self, vocab: Optional[Vocabulary] = None) -> None:
         self.__inner: ChainDict = dict()
+        self.__vocab = vocab if vocab is not None else Vocabulary()
 
     def prefixes(self, state_size: int) -> List[Prefix]:
         return list(self.__inner[state_size])
@@ -32,6 +168,15 @@ class Chain:
     def inner(self) -> ChainDict:
         return self.__inner
 
+    def vocab(self) -> Vocabulary:
+        return self.__vocab
+
+    def sampling_table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        suffixes = self.suffixes_of(prefix)
+        if suffixes is None:
+            return None
+        return SamplingTable.from_counts(suffixes)
+
     def state_sizes(self) -> List[int]:
         return list(self.__inner.keys())
 
@@ -49,61 +194,331 @@ class Chain:
             else:
                 suffixes[suffix] = 1
 
+    def insert_history(self, history: Sequence[Suffix],
+                       suffix: Suffix) -> None:
+        if len(history) == 0:
+            self.insert((), suffix)
+        for state_size in range(1, len(history) + 1):
+            self.insert(tuple(history[-state_size:]), suffix)
+
+    def merge(self, other: Chain) -> Chain:
+        """
+        Add the counts of another chain into this one. Tokens of the other
+        chain are interned into this chain's vocabulary as needed.
+        """
+        other_vocab = other.vocab()
+        if other_vocab is self.__vocab:
+            remap = list(range(0, len(other_vocab)))
+        else:
+            remap = [self.__vocab.intern(token)
+                     for token in other_vocab.tokens()]
+
+        for state_size, other_group in other.inner().items():
+            group = self.__inner.setdefault(state_size, dict())
+            for other_prefix, other_suffixes in other_group.items():
+                prefix = tuple(remap[t] for t in other_prefix)
+                suffixes = group.get(prefix)
+                if suffixes is None:
+                    group[prefix] = {remap[s]: c
+                                     for s, c in other_suffixes.items()}
+                    continue
 
-class ChainBuilder:
-    def __init__(self, max_state_size: int = 3) -> None:
-        self.__tokenizer = Tokenizer()
-        self.__max_state_size = max_state_size
+                for other_suffix, count in other_suffixes.items():
+                    suffix = remap[other_suffix]
+                    suffixes[suffix] = suffixes.get(suffix, 0) + count
 
-        self.__chain = Chain()
+        return self
 
-    def add(self, text: Text) -> ChainBuilder:
-        previous = [_ChainState(n)
-                    for n in range(0, self.__max_state_size + 1)]
+    def subtract(self, other: Chain) -> Chain:
+        """
+        Remove the counts of another chain from this one, such as those of a
+        text that was merged in earlier. Suffixes whose counts drop to zero
+        and prefixes left without suffixes are removed; tokens stay in the
+        vocabulary.
+        """
+        id_of = self.__vocab.id_of
+        remap = [id_of(token) for token in other.vocab().tokens()]
+
+        for state_size, other_group in other.inner().items():
+            group = self.__inner.get(state_size)
+            if group is None:
+                continue
 
-        chain = self.__chain
+            for other_prefix, other_suffixes in other_group.items():
+                prefix = tuple(remap[t] for t in other_prefix)
+                suffixes = group.get(prefix)
+                if suffixes is None:
+                    continue
 
-        for line in text.lines():
-            if len(line) == 0:
-                continue
+                for other_suffix, count in other_suffixes.items():
+                    suffix = remap[other_suffix]
+                    remaining = suffixes.get(suffix, 0) - count
+                    if remaining > 0:
+                        suffixes[suffix] = remaining
+                    else:
+                        suffixes.pop(suffix, None)
+                if len(suffixes) == 0:
+                    del group[prefix]
 
-            units = self.__tokenizer.tokenize(line)
-            if len(units) <= 1:
-                continue
+            if len(group) == 0:
+                del self.__inner[state_size]
+
+        return self
 
-            for unit in units:
-                if len(unit) == 0:
+    def prune(self, min_count: int = 1, min_prefix_count: int = 1,
+              top_k: Optional[int] = None) -> PruneStats:
+        """
+        Drop suffixes seen fewer than min_count times and, if top_k is given,
+        all but the top_k most frequent suffixes of each prefix. Prefixes seen
+        fewer than min_prefix_count times in total, or left without suffixes,
+        are dropped as well.
+        """
+        stats = PruneStats()
+
+        for state_size, group in self.__inner.items():
+            stats.bytes_before += container_size(group)
+
+            pruned: SizeGroup = dict()
+            for prefix, suffixes in group.items():
+                if sum(suffixes.values()) < min_prefix_count:
+                    stats.prefixes_removed += 1
+                    stats.suffixes_removed += len(suffixes)
                     continue
 
-                is_start = True
-                for state_size, _ in enumerate(previous):
-                    state = previous[state_size]
+                kept = suffixes
+                if top_k is not None and len(kept) > top_k:
+                    ranked = sorted(kept.items(), key=lambda e: e[1],
+                                    reverse=True)
+                    kept = dict(ranked[:top_k])
+                if min_count > 1:
+                    kept = {suffix: count for suffix, count in kept.items()
+                            if count >= min_count}
+
+                stats.suffixes_removed += len(suffixes) - len(kept)
+                if len(kept) == 0:
+                    stats.prefixes_removed += 1
+                else:
+                    pruned[prefix] = kept if kept is suffixes else dict(kept)
+
+            # Rebuild rather than delete in place; dicts do not shrink.
+            self.__inner[state_size] = pruned
+            stats.bytes_after += container_size(pruned)
+
+        return stats
+
+
+class PruneStats:
+    """
+    Entries removed by Chain.prune, and the estimated size of the chain's
+    dicts before and after pruning.
+    """
+
+    def __init__(self) -> None:
+        self.prefixes_removed = 0
+        self.suffixes_removed = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+    def __str__(self) -> str:
+        return 'removed {} prefixes, {} suffixes, saved {} of {} bytes'.format(
+            self.prefixes_removed, self.suffixes_removed, self.bytes_saved(),
+            self.bytes_before)
 
-                    if state.is_filled():
-                        chain.insert(state.pieces, unit)
-                        is_start = False
 
-                    state.shift_new(unit)
+class ChainBuilder:
+    """
+    Builds a chain from texts. Counts go into store, a new Chain by default;
+    pass a TrieChain to share storage between state sizes. If a profile is
+    given, lines and tokens are counted and tokenizing and inserting are timed
+    into it.
+    """
+
+    def __init__(self, max_state_size: int = 3,
+                 tokenizer: Optional[Tokenizer] = None,
+                 store: Optional[ChainStore] = None,
+                 profile: Optional[Profile] = None) -> None:
+        self.__tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+        self.__max_state_size = max_state_size
+        self.__profile = profile
+
+        self.__chain = store if store is not None else Chain()
 
-                if is_start:
-                    chain.insert(tuple(), unit)
+    def add(self, text: Text) -> ChainBuilder:
+        """
+        Add all lines of the text, carrying prefixes across line boundaries.
+        """
+        history: List[Suffix] = []
+        for line in text.lines():
+            self.__add_line(line, history)
 
         return self
 
-    def finish(self) -> Chain:
-        return self.__chain
+    def add_lines(self, lines: Iterable[str],
+                  progress: Optional[Callable[[IngestProgress], None]] = None,
+                  progress_every: int = 10000) -> ChainBuilder:
+        """
+        Add every line as a separate text, updating counts as the lines are
+        consumed, so the lines may come from an unbounded stream. If given,
+        progress is called every progress_every lines and once at the end.
+        """
+        report = IngestProgress()
+        start = time.perf_counter()
+
+        history: List[Suffix] = []
+        for line in lines:
+            history.clear()
+            report.tokens += self.__add_line(line, history)
+            report.lines += 1
+            report.chars += len(line)
+
+            if progress is not None and report.lines % progress_every == 0:
+                report.update(time.perf_counter() - start)
+                progress(report)
+
+        if progress is not None:
+            report.update(time.perf_counter() - start)
+            progress(report)
+
+        return self
+
+    def add_lines_sketched(self, lines: Callable[[], Iterable[str]],
+                           min_count: int = 2, min_prefix_count: int = 1,
+                           memory: int = 64 * 1024 * 1024,
+                           depth: int = 4) -> ChainBuilder:
+        """
+        Add every line as a separate text, as add_lines does, but keep only
+        the n-grams that Chain.prune(min_count, min_prefix_count) would keep,
+        without holding the rest in memory.
+
+        lines is called twice and must yield the same lines both times. The
+        first pass counts n-grams, and prefixes if min_prefix_count is above
+        1, in count-min sketches of about memory bytes in total; the second
+        inserts the n-grams whose estimated counts pass both thresholds, with
+        exact counts. Since the sketches only overestimate, every n-gram that
+        prune would keep is kept, along with a few whose counts collide with
+        frequent ones.
+        """
+        tokenize = self.__tokenizer.tokenize
+        max_state_size = self.__max_state_size
+
+        # Prefix counts are only needed for a prefix threshold.
+        prefixes = None
+        if min_prefix_count > 1:
+            prefixes = CountMinSketch.for_memory(memory // 2, depth)
+            memory -= memory // 2
+        ngrams = CountMinSketch.for_memory(memory, depth)
+
+        for line in lines():
+            for prefix, suffix in _ngrams(tokenize(line), max_state_size):
+                ngrams.add((prefix, suffix))
+                if prefixes is not None:
+                    prefixes.add(prefix)
 
+        chain = self.__chain
+        intern = chain.vocab().intern
+        for line in lines():
+            for prefix, suffix in _ngrams(tokenize(line), max_state_size):
+                if ngrams.estimate((prefix, suffix)) < min_count:
+                    continue
+                if prefixes is not None and \
+                        prefixes.estimate(prefix) < min_prefix_count:
+                    continue
+                chain.insert(tuple(map(intern, prefix)), intern(suffix))
 
-class _ChainState:
-    def __init__(self, state_size: int) -> None:
-        self.state_size = state_size
-        self.pieces: Tuple[str, ...] = ('',) * state_size
+        return self
 
-    def shift_new(self, new: str) -> None:
-        self.pieces = (*self.pieces[1:], new)
+    def finish(self) -> ChainStore:
+        return self.__chain
 
-    def is_filled(self) -> bool:
-        return all(piece != '' for piece in self.pieces)
+    def profile(self) -> Optional[Profile]:
+        return self.__profile
+
+    def __add_line(self, line: str, history: List[Suffix]) -> int:
+        """
+        Insert the tokens of the line, using and extending history as the
+        preceding tokens. Return the number of tokens inserted.
+        """
+        if len(line) == 0:
+            return 0
+
+        profile = self.__profile
+        if profile is not None:
+            start = time.perf_counter()
+        units = self.__tokenizer.tokenize(line)
+        if profile is not None:
+            tokenized = time.perf_counter()
+            profile.add_time('tokenize', tokenized - start)
+
+        chain = self.__chain
+        intern = chain.vocab().intern
+        insert_history = chain.insert_history
+        max_state_size = self.__max_state_size
+
+        n = 0
+        for token in units:
+            if len(token) == 0:
+                continue
+            unit = intern(token)
+
+            insert_history(history, unit)
+
+            history.append(unit)
+            if len(history) > max_state_size:
+                del history[0]
+            n += 1
+
+        if profile is not None:
+            profile.add_time('insert', time.perf_counter() - tokenized)
+            profile.count('lines')
+            profile.count('tokens', n)
+        return n
+
+
+def _ngrams(tokens: List[str],
+            max_state_size: int) -> Iterator[Tuple[Tuple[str, ...], str]]:
+    """
+    Yield the (prefix, suffix) pairs of tokens that ChainBuilder inserts for
+    a line, as token strings.
+    """
+    history: List[str] = []
+    for token in tokens:
+        if len(token) == 0:
+            continue
+
+        if len(history) == 0:
+            yield (), token
+        for state_size in range(1, len(history) + 1):
+            yield tuple(history[-state_size:]), token
+
+        history.append(token)
+        if len(history) > max_state_size:
+            del history[0]
+
+
+class IngestProgress:
+    """
+    Running totals reported by ChainBuilder.add_lines.
+    """
+
+    def __init__(self) -> None:
+        self.lines = 0
+        self.tokens = 0
+        self.chars = 0
+        self.elapsed = 0.0
+        self.peak_rss: Optional[int] = None
+
+    def update(self, elapsed: float) -> None:
+        self.elapsed = elapsed
+        self.peak_rss = peak_rss()
+
+    def __str__(self) -> str:
+        rss = 'unknown' if self.peak_rss is None \
+            else '{:.1f} MiB'.format(self.peak_rss / (1024 * 1024))
+        return '{} lines, {} tokens in {:.1f}s, peak RSS {}'.format(
+            self.lines, self.tokens, self.elapsed, rss)
 
 
 class Text(ABC):
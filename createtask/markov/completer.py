@@ -1,30 +1,96 @@
 from __future__ import annotations
 
+import math
+import os
+import time
 from datetime import datetime
+from multiprocessing import Pool
 from random import Random
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple, Union
 
-from .chain import Chain, Prefix, Suffix
+from .backoff import BackoffModel
+from .chain import ChainView, Prefix, SamplingTable, Suffix, SuffixData
+from .profile import Profile
+from .reach import Reachability
+from .sampling import Sampler, ranked
+from .vocab import Vocabulary
+
+# Index of a job in a batch and the prefix to complete.
+_Job = Tuple[int, Prefix]
 
 
 class Completer:
+    """
+    Sentence generator over a chain. If a backoff model of the chain is given,
+    sentences are generated by stepping through its contexts instead of
+    looking up prefixes in the chain, and are drawn from its interpolated
+    distribution if the model is interpolated.
+
+    sampler picks each suffix from its prefix's sampling table; by default
+    suffixes are drawn in proportion to their counts.
+
+    If a Reachability of a backoff model is given, sentences are generated
+    through it instead, so they only take steps from which a sentence ending
+    can still be reached.
+
+    If a profile is given, lookups, backoff depths, sampling and whole
+    completions are counted and timed into it.
+    """
+
     ENDINGS = ['.', '?', '!', '…']
 
-    def __init__(self, chain: Chain, max_state_size: Optional[int] = None,
-                 rand: Optional[Random] = None) -> None:
+    def __init__(self, chain: ChainView, max_state_size: Optional[int] = None,
+                 rand: Optional[Random] = None,
+                 backoff: Optional[BackoffModel] = None,
+                 sampler: Optional[Sampler] = None,
+                 profile: Optional[Profile] = None,
+                 reachability: Optional[Reachability] = None) -> None:
         self.__chain = chain
         self.__max_state_size = max_state_size
+        self.__backoff = backoff
+        self.__sampler = sampler
+        self.__profile = profile
+        self.__reachability = reachability
+
+        vocab = chain.vocab()
+        self.__endings = frozenset(vocab.id_of(ending)
+                                   for ending in self.ENDINGS
+                                   if ending in vocab)
 
         if rand is None:
-            self.__rand = Random(datetime.now())
+            self.__rand = Random(datetime.now().timestamp())
         else:
             self.__rand = rand
 
-    def sentences(self, prefix: Prefix = (),
-                  min_n: int = 3, min_c: int = 0) -> List[str]:
+    def sentences(self, prefix: Prefix = (), min_n: int = 3, min_c: int = 0,
+                  max_tokens: Optional[int] = None,
+                  deadline: Optional[float] = None) -> List[Suffix]:
         """
-        Given a prefix, complete multiple sentences.
+        Given a prefix of token IDs, complete multiple sentences. The returned
+        token IDs can be mapped back to tokens with the chain's vocabulary.
+
+        Generation stops early, returning what has been generated so far,
+        after max_tokens tokens or once time.monotonic() reaches deadline.
         """
+        profile = self.__profile
+        if profile is None:
+            return self.__sentences(prefix, min_n, min_c, max_tokens,
+                                    deadline)
+
+        with profile.timer('generate'):
+            sent = self.__sentences(prefix, min_n, min_c, max_tokens,
+                                    deadline)
+        profile.count('sentences')
+        profile.count('generated', len(sent))
+        return sent
+
+    def __sentences(self, prefix: Prefix, min_n: int, min_c: int,
+                    max_tokens: Optional[int],
+                    deadline: Optional[float]) -> List[Suffix]:
+        if self.__backoff is not None or self.__reachability is not None:
+            return self.__sentences_backoff(prefix, min_n, min_c, max_tokens,
+                                            deadline)
+
         max_state_size = self.max_state_size()
         if max_state_size is None:
             return []
@@ -32,7 +98,7 @@ class Completer:
         n = 0
         c = 0
         sent = []
-        while True:
+        while _within(c, max_tokens, deadline):
             suffix = self.suffix_any(prefix)
             if suffix is not None:
                 sent.append(suffix)
@@ -53,13 +119,196 @@ class Completer:
 
         return sent
 
-    def sentence(self, prefix: Prefix = (), min_c: int = 0) -> List[str]:
+    def __sentences_backoff(self, prefix: Prefix, min_n: int, min_c: int,
+                            max_tokens: Optional[int],
+                            deadline: Optional[float]) -> List[Suffix]:
+        backoff: Union[BackoffModel, Reachability, None] = \
+            self.__reachability if self.__reachability is not None \
+            else self.__backoff
+        assert backoff is not None
+
+        n = 0
+        c = 0
+        sent = []
+        profile = self.__profile
+        context = backoff.context_of(prefix)
+        while _within(c, max_tokens, deadline):
+            if profile is None:
+                step = backoff.step(context, self.__rand, self.__sampler)
+            else:
+                start = time.perf_counter()
+                step = backoff.step(context, self.__rand, self.__sampler)
+                profile.add_time('step', time.perf_counter() - start)
+            if step is None:
+                break
+            suffix, context = step
+            sent.append(suffix)
+
+            c += 1
+            if self.__is_ending(suffix):
+                n += 1
+                if n > min_n and c > min_c:
+                    break
+
+        return sent
+
+    def sentence(self, prefix: Prefix = (), min_c: int = 0,
+                 max_tokens: Optional[int] = None,
+                 deadline: Optional[float] = None) -> List[Suffix]:
         """
         Given a prefix, complete the sentence.
         """
-        return self.sentences(prefix, 1, min_c)
+        return self.sentences(prefix, 1, min_c, max_tokens, deadline)
+
+    def beam_search(self, prefix: Prefix = (), k: int = 5,
+                    beam_width: int = 16, max_tokens: int = 50,
+                    deadline: Optional[float] = None) \
+            -> List[Tuple[List[Suffix], float]]:
+        """
+        Return the k most likely completions of prefix up to and including
+        the first sentence ending, with their natural log-probabilities, most
+        likely first. Each step keeps the beam_width most likely partial
+        completions, extending each by its beam_width most frequent suffixes,
+        and backs off as suffix_any does.
 
-    def suffix_n(self, prefix: Prefix, n: int) -> Optional[List[str]]:
+        The search stops after max_tokens tokens or once time.monotonic()
+        reaches deadline. If fewer than k completions have ended by then, the
+        most likely unfinished ones make up the rest.
+        """
+        max_state_size = self.max_state_size()
+        if max_state_size is None:
+            return []
+
+        # Each beam is (log-probability, completion, history).
+        beams: List[Tuple[float, List[Suffix], Prefix]] = [(0.0, [], prefix)]
+        finished: List[Tuple[float, List[Suffix]]] = []
+        c = 0
+        while len(beams) != 0 and _within(c, max_tokens, deadline):
+            c += 1
+
+            candidates = []
+            for logp, sent, history in beams:
+                table = self.__table_any(history)
+                if table is None:
+                    finished.append((logp, sent))
+                    continue
+
+                top = ranked(table, 1.0)
+                for i in range(0, min(beam_width, len(top.suffixes))):
+                    suffix = top.suffixes[i]
+                    previous = top.cum_weights[i - 1] if i > 0 else 0
+                    p = (top.cum_weights[i] - previous) / top.total
+                    candidates.append((logp + math.log(p), [*sent, suffix],
+                                       (*history, suffix)[-max_state_size:]))
+
+            candidates.sort(key=lambda e: e[0], reverse=True)
+            beams = []
+            for logp, sent, history in candidates:
+                if self.__is_ending(sent[-1]):
+                    finished.append((logp, sent))
+                elif len(beams) < beam_width:
+                    beams.append((logp, sent, history))
+
+            # Probabilities only shrink, so no live beam can overtake k
+            # finished completions that are all more likely.
+            finished.sort(key=lambda e: e[0], reverse=True)
+            del finished[k:]
+            if len(finished) == k and \
+                    (len(beams) == 0 or finished[-1][0] >= beams[0][0]):
+                break
+
+        results = finished + [(logp, sent) for logp, sent, _ in beams]
+        results.sort(key=lambda e: e[0], reverse=True)
+        return [(sent, logp) for logp, sent in results[:k]]
+
+    def generate_batch(self, prefixes: List[Prefix], n: int = 1,
+                       min_n: int = 1, min_c: int = 0,
+                       processes: Optional[int] = None,
+                       seed: Optional[int] = None,
+                       max_tokens: Optional[int] = None,
+                       deadline: Optional[float] = None) \
+            -> List[List[List[Suffix]]]:
+        """
+        Complete each prefix n times, returning the n completions of each
+        prefix in order. Each completion is as produced by sentences, bounded
+        by max_tokens and deadline.
+
+        Every completion draws from its own Random stream derived from seed
+        and its position in the batch, so results for a given seed are the
+        same however the batch is split. Lookups are cached for the duration
+        of the batch, so identical prefixes share them. If processes is
+        greater than 1, the batch is split across a process pool; the chain,
+        backoff model and reachability must then be picklable. Profiles
+        recorded by the workers are merged into this completer's profile.
+        """
+        if seed is None:
+            seed = self.__rand.getrandbits(64)
+
+        jobs = [(i * n + j, prefix)
+                for i, prefix in enumerate(prefixes)
+                for j in range(0, n)]
+        params = (self.__max_state_size, self.__sampler, min_n, min_c,
+                  max_tokens, deadline, seed, self.__profile is not None)
+
+        if processes is None or processes <= 1 or len(jobs) <= 1:
+            results, profile = _complete_jobs(self.__chain, self.__backoff,
+                                              self.__reachability, jobs,
+                                              params)
+            self.__merge_profile(profile)
+        else:
+            processes = min(processes, os.cpu_count() or 1, len(jobs))
+            chunk_size = -(-len(jobs) // processes)
+            chunks = [(jobs[i:i + chunk_size], params)
+                      for i in range(0, len(jobs), chunk_size)]
+
+            results = []
+            with Pool(processes, initializer=_init_worker,
+                      initargs=(self.__chain, self.__backoff,
+                                self.__reachability)) as pool:
+                for chunk_results, profile in pool.map(_complete_chunk,
+                                                       chunks):
+                    results.extend(chunk_results)
+                    self.__merge_profile(profile)
+
+        return [results[i * n:(i + 1) * n] for i in range(0, len(prefixes))]
+
+    def generate_lockstep(self, prefixes: List[Prefix], n: int = 1,
+                          min_n: int = 1, min_c: int = 0,
+                          max_tokens: int = 200,
+                          deadline: Optional[float] = None,
+                          seed: Optional[int] = None) \
+            -> List[List[List[Suffix]]]:
+        """
+        Complete each prefix n times like generate_batch, but advance every
+        completion together one token at a time, sampling each step for the
+        whole batch at once. The chain must be an ArrayChain, and suffixes
+        are drawn in proportion to their counts, backing off as a
+        non-interpolated backoff model does; the sampler is not used.
+        """
+        # Imported here so that only lockstep generation loads arrays.
+        from .arrays import ArrayChain
+
+        chain = self.__chain
+        if not isinstance(chain, ArrayChain):
+            raise TypeError('Lockstep generation needs an ArrayChain')
+        if seed is None:
+            seed = self.__rand.getrandbits(64)
+
+        jobs = [prefix for prefix in prefixes for _ in range(0, n)]
+        profile = self.__profile
+        if profile is None:
+            results = chain.generate(jobs, self.__endings, min_n, min_c,
+                                     max_tokens, deadline, seed)
+        else:
+            with profile.timer('generate_lockstep'):
+                results = chain.generate(jobs, self.__endings, min_n, min_c,
+                                         max_tokens, deadline, seed)
+            profile.count('sentences', len(results))
+            profile.count('generated', sum(len(sent) for sent in results))
+
+        return [results[i * n:(i + 1) * n] for i in range(0, len(prefixes))]
+
+    def suffix_n(self, prefix: Prefix, n: int) -> Optional[List[Suffix]]:
         """
         Given a prefix, produce a list of n suffixes, using the latest suffixes
         as prefixes for the next.
@@ -86,32 +335,72 @@ class Completer:
         Return a random suffix for the given prefix, searching the chain for
         any suffix for an ending sub-prefix.
         """
-        if len(prefix) == 0:
-            return self.suffix(())
+        if self.__profile is not None:
+            return self.__profiled_suffix_any(prefix, self.__profile)
 
-        suffix = None
-        while len(prefix) != 0:
-            suffix = self.suffix(prefix)
-            if suffix is not None:
-                break
-            else:
-                prefix = prefix[1:]
-        return suffix
+        table = self.__table_any(prefix)
+        if table is None:
+            return None
+        if self.__sampler is not None:
+            return self.__sampler.sample(table, self.__rand)
+        return table.sample(self.__rand)
 
     def suffix(self, prefix: Prefix) -> Optional[Suffix]:
         """
         Return a random suffix for the given prefix.
         """
-        suffixes = self.__chain.suffixes_of(prefix)
-        if suffixes is not None:
-            suffix_list = list(suffixes)
-            weights = list(suffixes.values())
+        table = self.__chain.sampling_table(prefix)
+        if table is None:
+            return None
+        if self.__sampler is not None:
+            return self.__sampler.sample(table, self.__rand)
+        return table.sample(self.__rand)
 
-            return self.__rand.choices(population=suffix_list,
-                                       weights=weights,
-                                       k=1)[0]
-        else:
+    def __profiled_suffix_any(self, prefix: Prefix,
+                              profile: Profile) -> Optional[Suffix]:
+        """
+        suffix_any, recording the lookups and backoff depth it takes and the
+        time spent looking up and sampling.
+        """
+        chain = self.__chain
+        start = time.perf_counter()
+
+        depth = 0
+        table = chain.sampling_table(prefix)
+        while table is None and len(prefix) > 1:
+            prefix = prefix[1:]
+            depth += 1
+            table = chain.sampling_table(prefix)
+
+        looked_up = time.perf_counter()
+        profile.add_time('lookup', looked_up - start)
+        profile.count('lookups', depth + 1)
+        if table is None:
+            profile.count('lookup_misses')
             return None
+        profile.observe('backoff_depth', depth)
+
+        if self.__sampler is not None:
+            suffix = self.__sampler.sample(table, self.__rand)
+        else:
+            suffix = table.sample(self.__rand)
+        profile.add_time('sample', time.perf_counter() - looked_up)
+        return suffix
+
+    def __table_any(self, prefix: Prefix) -> Optional[SamplingTable]:
+        """
+        Return the sampling table of the longest ending sub-prefix that is in
+        the chain.
+        """
+        if len(prefix) == 0:
+            return self.__chain.sampling_table(())
+
+        while len(prefix) != 0:
+            table = self.__chain.sampling_table(prefix)
+            if table is not None:
+                return table
+            prefix = prefix[1:]
+        return None
 
     def word(self) -> Optional[Prefix]:
         """
@@ -129,20 +418,17 @@ class Completer:
         Return a random start word from the chain. The prefix is selected from
         state size = 0 group.
         """
-        suffixes = self.__chain.suffixes_of(())
-        if suffixes is not None:
-            suffix = self.__rand.choices(list(suffixes.keys()),
-                                         weights=list(suffixes.values()))
-            if len(suffix) != 0:
-                return suffix[0]
-        else:
-            return None
+        return self.suffix(())
 
     def __is_ending(self, s: Suffix) -> bool:
-        for ending in self.ENDINGS:
-            if s == ending:
-                return True
-        return False
+        return s in self.__endings
+
+    def profile(self) -> Optional[Profile]:
+        return self.__profile
+
+    def __merge_profile(self, profile: Optional[Profile]) -> None:
+        if self.__profile is not None and profile is not None:
+            self.__profile.merge(profile)
 
     def max_state_size(self) -> Optional[int]:
         if self.__max_state_size is not None:
@@ -153,3 +439,84 @@ class Completer:
             return None
 
         return max(max_state_size)
+
+
+class _CachedChain(ChainView):
+    """
+    Chain wrapper that remembers sampling tables looked up through it.
+    """
+
+    def __init__(self, chain: ChainView) -> None:
+        self.__chain = chain
+        self.__tables: Dict[Prefix, Optional[SamplingTable]] = dict()
+
+    def prefixes(self, state_size: int) -> List[Prefix]:
+        return self.__chain.prefixes(state_size)
+
+    def suffixes_of(self, prefix: Prefix) -> Optional[SuffixData]:
+        return self.__chain.suffixes_of(prefix)
+
+    def state_sizes(self) -> List[int]:
+        return self.__chain.state_sizes()
+
+    def vocab(self) -> Vocabulary:
+        return self.__chain.vocab()
+
+    def sampling_table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        tables = self.__tables
+        if prefix in tables:
+            return tables[prefix]
+
+        table = self.__chain.sampling_table(prefix)
+        tables[prefix] = table
+        return table
+
+
+def _within(c: int, max_tokens: Optional[int],
+            deadline: Optional[float]) -> bool:
+    """
+    Return whether generation may continue after c tokens.
+    """
+    if max_tokens is not None and c >= max_tokens:
+        return False
+    return deadline is None or time.monotonic() < deadline
+
+
+_worker_chain: Optional[ChainView] = None
+_worker_backoff: Optional[BackoffModel] = None
+_worker_reachability: Optional[Reachability] = None
+
+
+def _init_worker(chain: ChainView, backoff: Optional[BackoffModel],
+                 reachability: Optional[Reachability]) -> None:
+    global _worker_chain, _worker_backoff, _worker_reachability
+    _worker_chain = chain
+    _worker_backoff = backoff
+    _worker_reachability = reachability
+
+
+def _complete_chunk(task: Tuple[List[_Job], tuple]) \
+        -> Tuple[List[List[Suffix]], Optional[Profile]]:
+    jobs, params = task
+    assert _worker_chain is not None
+    return _complete_jobs(_worker_chain, _worker_backoff,
+                          _worker_reachability, jobs, params)
+
+
+def _complete_jobs(chain: ChainView, backoff: Optional[BackoffModel],
+                   reachability: Optional[Reachability], jobs: List[_Job],
+                   params: tuple) \
+        -> Tuple[List[List[Suffix]], Optional[Profile]]:
+    max_state_size, sampler, min_n, min_c, max_tokens, deadline, seed, \
+        profiled = params
+    profile = Profile() if profiled else None
+
+    cached = _CachedChain(chain)
+    results = []
+    for index, prefix in jobs:
+        rand = Random('{}:{}'.format(seed, index))
+        completer = Completer(cached, max_state_size, rand, backoff, sampler,
+                              profile, reachability)
+        results.append(completer.sentences(prefix, min_n, min_c, max_tokens,
+                                           deadline))
+    return results, profile
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .backoff import NO_CONTEXT, BackoffModel
+from .tokenize import Tokenizer
+from .vocab import Vocabulary
+
+
+class Evaluation:
+    """
+    Log-likelihood of a text under a model. Tokens that are not in the
+    vocabulary are counted in oov and left out of the score; tokens the model
+    gives no probability are counted in zero and scored with the evaluator's
+    floor probability.
+    """
+
+    def __init__(self) -> None:
+        self.lines = 0
+        self.tokens = 0
+        self.oov = 0
+        self.zero = 0
+        self.log_likelihood = 0.0
+
+    def cross_entropy(self) -> float:
+        """
+        Return the average negative log-likelihood in bits per token.
+        """
+        if self.tokens == 0:
+            return 0.0
+        return -self.log_likelihood / self.tokens / math.log(2)
+
+    def perplexity(self) -> float:
+        if self.tokens == 0:
+            return 0.0
+        return math.exp(-self.log_likelihood / self.tokens)
+
+    def __str__(self) -> str:
+        return ('{} lines, {} tokens ({} oov, {} zero), perplexity {:.2f}, '
+                '{:.3f} bits/token').format(
+            self.lines, self.tokens, self.oov, self.zero, self.perplexity(),
+            self.cross_entropy())
+
+
+class Evaluator:
+    """
+    Scores held-out lines under an interpolated backoff model. Each line is
+    scored as its own text starting from the empty context, as
+    ChainBuilder.add_lines builds it, and every token is scored by
+    model.probability from the context that precedes it. Models that are not
+    interpolated give no probability to tokens unseen after the longest
+    matching context, so they are rejected.
+
+    Lines are scored in batches of batch_size tokens. If NumPy is installed,
+    the probabilities of a whole batch are computed with array operations by
+    model.probabilities and their logarithms summed with NumPy; otherwise
+    each distinct (context, token) pair of a batch is looked up once with
+    model.probability.
+    """
+
+    def __init__(self, model: BackoffModel,
+                 tokenizer: Optional[Tokenizer] = None,
+                 batch_size: int = 65536, floor: float = 1e-7) -> None:
+        if not model.interpolated():
+            raise ValueError('Evaluator needs an interpolated model')
+        self.__model = model
+        self.__tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+        self.__batch_size = batch_size
+        self.__floor = floor
+
+    def evaluate(self, lines: Iterable[str]) -> Evaluation:
+        vocab = self.__model.vocab()
+        result = Evaluation()
+        batch: List[Tuple[int, int]] = []
+        for line in lines:
+            if len(line) == 0:
+                continue
+            result.lines += 1
+
+            tokens = self.__tokenizer.tokenize(line)
+            ids = vocab.encode([token for token in tokens if token != ''])
+            self.__add_line(ids, batch, result)
+            if len(batch) >= self.__batch_size:
+                self.__score(batch, result)
+                batch.clear()
+
+        self.__score(batch, result)
+        return result
+
+    def __add_line(self, ids: Tuple[int, ...],
+                   batch: List[Tuple[int, int]], result: Evaluation) -> None:
+        model = self.__model
+        context = model.context_of(())
+        for token in ids:
+            if token == Vocabulary.UNKNOWN:
+                result.oov += 1
+                context = NO_CONTEXT
+                continue
+            batch.append((context, token))
+            context = model.follow(context, token)
+
+    def __score(self, batch: List[Tuple[int, int]],
+                result: Evaluation) -> None:
+        if len(batch) == 0:
+            return
+
+        # Imported here so that importing the package does not load NumPy.
+        try:
+            import numpy
+        except ImportError:
+            numpy = None  # type: ignore
+        if numpy is not None:
+            contexts, tokens = zip(*batch)
+            p = self.__model.probabilities(contexts, tokens)
+            zero = int(numpy.count_nonzero(p <= 0))
+            log_likelihood = float(
+                numpy.log(numpy.maximum(p, self.__floor)).sum())
+        else:
+            log_likelihood, zero = self.__sum_log(batch)
+        result.tokens += len(batch)
+        result.zero += zero
+        result.log_likelihood += log_likelihood
+
+    def __sum_log(self, batch: List[Tuple[int, int]]) -> Tuple[float, int]:
+        """
+        Return the sum of the natural logarithms of the probabilities of the
+        batch, with probabilities of zero replaced by floor, and the number of
+        zeros.
+        """
+        probability = self.__model.probability
+        cache: Dict[Tuple[int, int], float] = dict()
+        zero = 0
+        logs = []
+        for pair in batch:
+            p = cache.get(pair)
+            if p is None:
+                p = cache[pair] = probability(*pair)
+            if p <= 0:
+                zero += 1
+            logs.append(math.log(max(p, self.__floor)))
+        return math.fsum(logs), zero
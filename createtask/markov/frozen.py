@@ -0,0 +1,42 @@
+from typing import Dict, List, Optional
+
+from .chain import ChainView, Prefix, SamplingTable, SuffixData
+from .vocab import Vocabulary
+
+
+class FrozenChain(ChainView):
+    """
+    Immutable copy of a chain in which every prefix holds a precomputed
+    sampling table, so sampling a suffix does not allocate.
+    """
+
+    def __init__(self, chain: ChainView) -> None:
+        self.__vocab = chain.vocab()
+        self.__inner: Dict[int, Dict[Prefix, SamplingTable]] = dict()
+        for state_size in chain.state_sizes():
+            group = self.__inner[state_size] = dict()
+            for prefix in chain.prefixes(state_size):
+                suffixes = chain.suffixes_of(prefix)
+                if suffixes is not None:
+                    group[prefix] = SamplingTable.from_counts(suffixes)
+
+    def prefixes(self, state_size: int) -> List[Prefix]:
+        return list(self.__inner[state_size])
+
+    def suffixes_of(self, prefix: Prefix) -> Optional[SuffixData]:
+        table = self.sampling_table(prefix)
+        if table is None:
+            return None
+        return table.counts()
+
+    def state_sizes(self) -> List[int]:
+        return list(self.__inner.keys())
+
+    def vocab(self) -> Vocabulary:
+        return self.__vocab
+
+    def sampling_table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        group = self.__inner.get(len(prefix))
+        if group is None:
+            return None
+        return group.get(prefix)
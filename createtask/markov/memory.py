@@ -0,0 +1,45 @@
+import sys
+from typing import Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None  # type: ignore
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Return the peak resident set size of this process in bytes, or None if it
+    cannot be determined on this platform.
+    """
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024
+
+
+def container_size(obj: object) -> int:
+    """
+    Estimate the bytes held by nested dicts and tuples, counting the containers
+    themselves but not the ints in them, which are mostly shared token IDs and
+    small cached counts.
+    """
+    if obj == ():
+        # The empty tuple is a shared singleton.
+        return 0
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if not isinstance(key, int):
+                size += container_size(key)
+            if not isinstance(value, int):
+                size += container_size(value)
+    elif isinstance(obj, tuple):
+        for item in obj:
+            if not isinstance(item, int):
+                size += container_size(item)
+    return size
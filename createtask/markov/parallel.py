@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import os
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from .chain import Chain, ChainBuilder
+from .text import FileText
+from .tokenize import Tokenizer
+
+# Path, start byte offset and end byte offset of a slice of a corpus file.
+Shard = Tuple[str, int, int]
+
+
+class ParallelChainBuilder:
+    """
+    Builds a chain from corpus files by splitting them into byte-range shards
+    and ingesting the shards on a process pool. Each worker builds a partial
+    chain for its shard and the partial chains are merged in shard order, so
+    the result does not depend on the number of processes.
+
+    Every line is added as its own text, as with ChainBuilder.add_lines. Each
+    worker tokenizes with a cache of cache_size lines. Lines are cleaned as
+    FileText does unless clean is False, for files that were already cleaned,
+    such as those written by a Preprocessor.
+    """
+
+    DEFAULT_SHARD_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, max_state_size: int = 3,
+                 processes: Optional[int] = None,
+                 shard_size: int = DEFAULT_SHARD_SIZE,
+                 cache_size: int = 0, clean: bool = True) -> None:
+        self.__max_state_size = max_state_size
+        self.__processes = processes
+        self.__shard_size = shard_size
+        self.__cache_size = cache_size
+        self.__clean = clean
+
+        self.__chain = Chain()
+
+    def add_files(self, paths: List[Path]) -> ParallelChainBuilder:
+        for partial in self.file_chains(paths):
+            self.__chain.merge(partial)
+        return self
+
+    def file_chains(self, paths: List[Path]) -> List[Chain]:
+        """
+        Build a separate chain for each file, in the order of paths. The
+        files are sharded and ingested on the pool as with add_files, but
+        nothing is added to this builder's chain.
+        """
+        shards = [(i, shard) for i, path in enumerate(paths)
+                  for shard in _file_shards(path, self.__shard_size)]
+        tasks = [(shard, self.__max_state_size, self.__cache_size,
+                  self.__clean)
+                 for _, shard in shards]
+        chains = [Chain() for _ in paths]
+        if len(tasks) == 0:
+            return chains
+
+        processes = self.__processes
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(tasks))
+
+        if processes <= 1:
+            partials: Iterator[Chain] = map(_build_shard, tasks)
+            for (i, _), partial in zip(shards, partials):
+                chains[i].merge(partial)
+        else:
+            with Pool(processes) as pool:
+                partials = pool.imap(_build_shard, tasks)
+                for (i, _), partial in zip(shards, partials):
+                    chains[i].merge(partial)
+
+        return chains
+
+    def finish(self) -> Chain:
+        return self.__chain
+
+
+def _file_shards(path: Path, shard_size: int) -> List[Shard]:
+    size = path.stat().st_size
+    starts = range(0, max(size, 1), shard_size)
+    return [(str(path), start, min(start + shard_size, size))
+            for start in starts]
+
+
+def _build_shard(task: Tuple[Shard, int, int, bool]) -> Chain:
+    shard, max_state_size, cache_size, clean = task
+
+    chain = Chain()
+    builder = ChainBuilder(max_state_size=max_state_size,
+                           tokenizer=Tokenizer(cache_size=cache_size),
+                           store=chain)
+    if clean:
+        builder.add_lines(FileText(_shard_lines(shard)).lines())
+    else:
+        builder.add_lines(line.rstrip('\n') for line in _shard_lines(shard))
+    return chain
+
+
+def _shard_lines(shard: Shard) -> Iterator[str]:
+    """
+    Yield the lines of a file that start within the shard's byte range.
+    """
+    path, start, end = shard
+    with open(path, 'rb') as f:
+        if start > 0:
+            # Skip the line in progress at the start of the range; it belongs
+            # to the previous shard.
+            f.seek(start - 1)
+            f.readline()
+
+        while f.tell() < end:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            yield line.decode('utf-8')
@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import shutil
+import unicodedata
+from abc import ABC, abstractmethod
+from multiprocessing import Pool
+from pathlib import Path
+from typing import (Iterable, Iterator, List, Literal, Optional, Set, TextIO,
+                    Tuple)
+
+from .parallel import Shard, _file_shards, _shard_lines
+from .text import FileText
+
+
+class Normalizer(ABC):
+    """
+    Step of a preprocessor's normalizer chain, rewriting one line at a time.
+    Normalizers must be picklable to run on a process pool, and their repr
+    must identify what they do, since it keys the cleaned corpus cache.
+    """
+
+    @abstractmethod
+    def normalize(self, line: str) -> str:
+        pass
+
+
+class StripNormalizer(Normalizer):
+    """
+    Removes trailing whitespace.
+    """
+
+    def normalize(self, line: str) -> str:
+        return line.rstrip()
+
+    def __repr__(self) -> str:
+        return 'StripNormalizer()'
+
+
+class RegexNormalizer(Normalizer):
+    """
+    Replaces every match of pattern with replacement, as re.sub does.
+    """
+
+    def __init__(self, pattern: str, replacement: str) -> None:
+        self.__regexp = re.compile(pattern)
+        self.__replacement = replacement
+
+    def normalize(self, line: str) -> str:
+        return self.__regexp.sub(self.__replacement, line)
+
+    def __repr__(self) -> str:
+        return 'RegexNormalizer({!r}, {!r})'.format(self.__regexp.pattern,
+                                                    self.__replacement)
+
+
+class WhitespaceNormalizer(Normalizer):
+    """
+    Collapses runs of whitespace into single spaces and strips both ends.
+    """
+
+    def normalize(self, line: str) -> str:
+        return ' '.join(line.split())
+
+    def __repr__(self) -> str:
+        return 'WhitespaceNormalizer()'
+
+
+# Normalization forms accepted by unicodedata.normalize.
+_Form = Literal['NFC', 'NFD', 'NFKC', 'NFKD']
+
+
+class UnicodeNormalizer(Normalizer):
+    """
+    Applies a Unicode normalization form, as unicodedata.normalize does.
+    """
+
+    def __init__(self, form: _Form = 'NFC') -> None:
+        if form not in ('NFC', 'NFD', 'NFKC', 'NFKD'):
+            raise ValueError('Unknown normalization form {}'.format(form))
+        self.__form = form
+
+    def normalize(self, line: str) -> str:
+        return unicodedata.normalize(self.__form, line)
+
+    def __repr__(self) -> str:
+        return 'UnicodeNormalizer({!r})'.format(self.__form)
+
+
+def default_normalizers() -> List[Normalizer]:
+    """
+    Return the normalizers that clean lines as FileText does.
+    """
+    return [StripNormalizer(), *(RegexNormalizer(regexp.pattern, substitution)
+                                 for regexp, substitution
+                                 in FileText.CLEANERS)]
+
+
+class Preprocessor:
+    """
+    Cleans corpus files before chain building. Every line is passed through
+    the normalizer chain in order, and lines that are empty afterwards are
+    dropped, as ChainBuilder ignores them.
+
+    With dedup EXACT, only the first of identical lines within a file is
+    kept; with NEAR, lines are also duplicates if they differ only in case,
+    punctuation and whitespace; with None, every line is kept. Lines are
+    compared by 64-bit BLAKE2 digests, so the memory used grows with the
+    number of distinct lines rather than their length.
+
+    Files are split into byte-range shards that are normalized and hashed on
+    a process pool, and duplicates are removed in file order, so the result
+    does not depend on the number of processes. Each file's cleaned lines
+    are written to its own directory as shard files of about shard_size
+    characters, which ParallelChainBuilder can ingest with clean=False.
+    """
+
+    EXACT = 'exact'
+    NEAR = 'near'
+
+    DEFAULT_SHARD_SIZE = 4 * 1024 * 1024
+
+    SHARD_PATTERN = 'shard-{:05d}.txt'
+
+    def __init__(self, normalizers: Optional[List[Normalizer]] = None,
+                 dedup: Optional[str] = EXACT,
+                 processes: Optional[int] = None,
+                 shard_size: int = DEFAULT_SHARD_SIZE) -> None:
+        if dedup not in (None, self.EXACT, self.NEAR):
+            raise ValueError('Unknown dedup mode {}'.format(dedup))
+        self.__normalizers = normalizers if normalizers is not None \
+            else default_normalizers()
+        self.__dedup = dedup
+        self.__processes = processes
+        self.__shard_size = shard_size
+
+    def key(self) -> str:
+        """
+        Return a short digest of the normalizers and dedup mode, to tell
+        apart caches of corpora cleaned differently.
+        """
+        config = repr((self.__normalizers, self.__dedup))
+        return hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]
+
+    def clean(self, lines: Iterable[str]) -> Iterator[str]:
+        """
+        Normalize and deduplicate lines in this process.
+        """
+        seen: Set[int] = set()
+        task = (self.__normalizers, self.__dedup)
+        for line, digest in _clean_lines(lines, task):
+            if digest is not None:
+                if digest in seen:
+                    continue
+                seen.add(digest)
+            yield line
+
+    def clean_files(self, paths: List[Path],
+                    directories: List[Path]) -> List[List[Path]]:
+        """
+        Clean each file of paths into the directory at the same position of
+        directories and return the shard files of each, in order. A file
+        whose directory already exists is not read again; its shards are
+        reused. Directories are written through a temporary directory and
+        renamed into place, so they are always complete.
+        """
+        cached = [cleaned_shards(directory) for directory in directories]
+        pending = [i for i, shards in enumerate(cached) if shards is None]
+
+        shards = [(i, shard) for i in pending
+                  for shard in _file_shards(paths[i], self.__shard_size)]
+        tasks = [(shard, self.__normalizers, self.__dedup)
+                 for _, shard in shards]
+        if len(tasks) == 0:
+            return [shards for shards in cached if shards is not None]
+
+        processes = self.__processes
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(tasks))
+
+        if processes <= 1:
+            self.__write_all(directories, shards, map(_clean_shard, tasks))
+        else:
+            with Pool(processes) as pool:
+                self.__write_all(directories, shards,
+                                 pool.imap(_clean_shard, tasks))
+
+        return [cleaned_shards(directory) or [] for directory in directories]
+
+    def __write_all(self, directories: List[Path],
+                    shards: List[Tuple[int, Shard]],
+                    results: Iterable[List[Tuple[str, Optional[int]]]]) \
+            -> None:
+        writer: Optional[_ShardWriter] = None
+        current = -1
+        seen: Set[int] = set()
+        for (i, _), lines in zip(shards, results):
+            if i != current:
+                if writer is not None:
+                    writer.close()
+                writer = _ShardWriter(directories[i], self.__shard_size)
+                current = i
+                seen.clear()
+
+            assert writer is not None
+            for line, digest in lines:
+                if digest is not None:
+                    if digest in seen:
+                        continue
+                    seen.add(digest)
+                writer.write(line)
+
+        if writer is not None:
+            writer.close()
+
+
+def cleaned_shards(directory: Path) -> Optional[List[Path]]:
+    """
+    Return the shard files of a cleaned corpus directory in order, or None
+    if it has not been written.
+    """
+    if not directory.is_dir():
+        return None
+    return sorted(directory.glob('shard-*.txt'))
+
+
+class _ShardWriter:
+    """
+    Writes lines into numbered shard files in a temporary directory, which
+    replaces directory on close.
+    """
+
+    def __init__(self, directory: Path, shard_size: int) -> None:
+        self.__directory = directory
+        self.__tmp = directory.with_name(directory.name + '.tmp')
+        if self.__tmp.exists():
+            shutil.rmtree(self.__tmp)
+        self.__tmp.mkdir(parents=True)
+
+        self.__shard_size = shard_size
+        self.__shards = 0
+        self.__size = 0
+        self.__f: Optional[TextIO] = None
+
+    def write(self, line: str) -> None:
+        if self.__f is None or self.__size >= self.__shard_size:
+            self.__next_shard()
+        assert self.__f is not None
+        self.__f.write(line)
+        self.__f.write('\n')
+        self.__size += len(line) + 1
+
+    def close(self) -> None:
+        if self.__f is not None:
+            self.__f.close()
+        if self.__directory.exists():
+            shutil.rmtree(self.__directory)
+        self.__tmp.replace(self.__directory)
+
+    def __next_shard(self) -> None:
+        if self.__f is not None:
+            self.__f.close()
+        name = Preprocessor.SHARD_PATTERN.format(self.__shards)
+        self.__f = open(self.__tmp.joinpath(name), 'w', encoding='utf-8')
+        self.__shards += 1
+        self.__size = 0
+
+
+def _clean_shard(task: Tuple[Shard, List[Normalizer], Optional[str]]) \
+        -> List[Tuple[str, Optional[int]]]:
+    shard, normalizers, dedup = task
+    return list(_clean_lines(_shard_lines(shard), (normalizers, dedup)))
+
+
+def _clean_lines(lines: Iterable[str],
+                 task: Tuple[List[Normalizer], Optional[str]]) \
+        -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Yield every line that is not empty after normalization, with the digest
+    it is deduplicated by, or None if lines are not deduplicated.
+    """
+    normalizers, dedup = task
+    for line in lines:
+        line = line.rstrip('\r\n')
+        for normalizer in normalizers:
+            line = normalizer.normalize(line)
+        if len(line) == 0:
+            continue
+
+        if dedup is None:
+            yield line, None
+            continue
+
+        key = line if dedup == Preprocessor.EXACT else _near_key(line)
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        yield line, int.from_bytes(digest, 'little')
+
+
+_NON_WORD = re.compile(r'\W+')
+
+
+def _near_key(line: str) -> str:
+    """
+    Return the line without case, punctuation or whitespace differences.
+    """
+    return _NON_WORD.sub(' ', line.casefold()).strip()
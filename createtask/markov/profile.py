@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import json
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, TextIO
+
+
+class Profile:
+    """
+    Counters, timers and histograms filled in by instrumented code. Completer
+    and ChainBuilder record into a profile only if one is passed to them;
+    otherwise each instrumented call costs a single check.
+    """
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, int] = dict()
+        self.seconds: Dict[str, float] = dict()
+        self.calls: Dict[str, int] = dict()
+        self.histograms: Dict[str, Dict[int, int]] = dict()
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name: str, seconds: float) -> None:
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def observe(self, name: str, value: int) -> None:
+        histogram = self.histograms.setdefault(name, dict())
+        histogram[value] = histogram.get(value, 0) + 1
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def merge(self, other: Profile) -> Profile:
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + other.calls[name]
+        for name, histogram in other.histograms.items():
+            mine = self.histograms.setdefault(name, dict())
+            for value, n in histogram.items():
+                mine[value] = mine.get(value, 0) + n
+        return self
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.seconds.clear()
+        self.calls.clear()
+        self.histograms.clear()
+
+    def to_dict(self) -> Dict:
+        return {
+            'counters': dict(self.counters),
+            'timers': {name: {'seconds': seconds, 'calls': self.calls[name]}
+                       for name, seconds in self.seconds.items()},
+            'histograms': {name: {str(value): n for value, n
+                                  in sorted(histogram.items())}
+                           for name, histogram in self.histograms.items()},
+        }
+
+    def dump(self, f: TextIO) -> None:
+        json.dump(self.to_dict(), f, indent=2)
+
+    def __str__(self) -> str:
+        lines = []
+        for name, n in sorted(self.counters.items()):
+            lines.append('{:>16}: {}'.format(name, n))
+        for name, seconds in sorted(self.seconds.items()):
+            calls = self.calls[name]
+            lines.append('{:>16}: {:.3f}s in {} calls, {:.2f} us/call'.format(
+                name, seconds, calls, seconds / calls * 1e6))
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append('{:>16}: {}'.format(name, ', '.join(
+                '{}={}'.format(value, n)
+                for value, n in sorted(histogram.items()))))
+        return '\n'.join(lines)
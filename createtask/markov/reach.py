@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+from random import Random
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .backoff import NO_CONTEXT, BackoffModel
+from .chain import Prefix, SamplingTable, Suffix
+from .sampling import Sampler
+
+
+class Reachability:
+    """
+    Contexts of a backoff model from which a walk can still finish. A step
+    from a context finishes the walk if it draws an ending token or leads to
+    NO_CONTEXT; a context is live if one of its steps finishes the walk or
+    leads to another live context. Walking the model only through steps into
+    live contexts, every context on the way can still reach an ending, so
+    walks cannot be trapped in cycles that never end a sentence.
+
+    step draws from each context's table cut down to those steps. Walks from
+    a dead context stop at once.
+    """
+
+    def __init__(self, model: BackoffModel, endings: Iterable[str]) -> None:
+        if model.interpolated():
+            raise ValueError('Reachability needs a model that is not '
+                             'interpolated')
+        self.__model = model
+
+        vocab = model.vocab()
+        ending_ids = frozenset(vocab.id_of(ending) for ending in endings
+                               if ending in vocab)
+
+        # Walk the context graph backwards from the steps that finish.
+        predecessors: List[List[int]] = [[] for _ in range(0, len(model))]
+        live = [False] * len(model)
+        pending = []
+        for context in range(0, len(model)):
+            suffixes = model.table_of(context).suffixes
+            for suffix, following in zip(suffixes, model.next_of(context)):
+                if following == NO_CONTEXT or suffix in ending_ids:
+                    if not live[context]:
+                        live[context] = True
+                        pending.append(context)
+                else:
+                    predecessors[following].append(context)
+        while len(pending) != 0:
+            for context in predecessors[pending.pop()]:
+                if not live[context]:
+                    live[context] = True
+                    pending.append(context)
+        self.__live = live
+
+        # Cut down the tables of live contexts that have steps into dead ones.
+        self.__tables: Dict[int, Tuple[SamplingTable, Tuple[int, ...]]] = \
+            dict()
+        for context in range(0, len(model)):
+            if live[context]:
+                self.__prune(context, ending_ids)
+
+    def context_of(self, prefix: Prefix) -> int:
+        return self.__model.context_of(prefix)
+
+    def is_live(self, context: int) -> bool:
+        return context != NO_CONTEXT and self.__live[context]
+
+    def dead(self) -> int:
+        """
+        Return the number of dead contexts.
+        """
+        return self.__live.count(False)
+
+    def table_of(self, context: int) -> SamplingTable:
+        """
+        Return the table of the steps from a live context that finish the
+        walk or lead to live contexts.
+        """
+        pruned = self.__tables.get(context)
+        if pruned is not None:
+            return pruned[0]
+        return self.__model.table_of(context)
+
+    def step(self, context: int, rand: Random,
+             sampler: Optional[Sampler] = None) \
+            -> Optional[Tuple[Suffix, int]]:
+        """
+        Return a random suffix of the context, among those that keep the walk
+        live, and the context that follows it, or None if the context is dead
+        or NO_CONTEXT.
+        """
+        if not self.is_live(context):
+            return None
+
+        pruned = self.__tables.get(context)
+        if pruned is None:
+            return self.__model.step(context, rand, sampler)
+
+        table, following = pruned
+        if sampler is not None:
+            suffix = sampler.sample(table, rand)
+            return suffix, self.__model.follow(context, suffix)
+
+        i = table.index(rand)
+        return table.suffixes[i], following[i]
+
+    def __prune(self, context: int, ending_ids: frozenset) -> None:
+        model = self.__model
+        table = model.table_of(context)
+        counts = dict()
+        kept = []
+        for (suffix, count), following in zip(table.counts().items(),
+                                              model.next_of(context)):
+            if following == NO_CONTEXT or suffix in ending_ids \
+                    or self.__live[following]:
+                counts[suffix] = count
+                kept.append(following)
+        if len(kept) != len(table.suffixes):
+            self.__tables[context] = (SamplingTable.from_counts(counts),
+                                      tuple(kept))
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from random import Random
+from typing import Optional
+
+from .chain import SamplingTable, Suffix
+
+
+class Sampler(ABC):
+    """
+    Strategy for picking a suffix from a prefix's sampling table.
+    """
+
+    @abstractmethod
+    def sample(self, table: SamplingTable, rand: Random) -> Suffix:
+        pass
+
+
+class WeightedSampler(Sampler):
+    """
+    Samples suffixes in proportion to their counts.
+    """
+
+    def sample(self, table: SamplingTable, rand: Random) -> Suffix:
+        return table.sample(rand)
+
+
+class GreedySampler(Sampler):
+    """
+    Always picks the most frequent suffix, the first seen among equals.
+    """
+
+    def sample(self, table: SamplingTable, rand: Random) -> Suffix:
+        return ranked(table, 1.0).suffixes[0]
+
+
+class TopKSampler(Sampler):
+    """
+    Samples among the k most frequent suffixes, in proportion to their counts
+    raised to 1 / temperature.
+    """
+
+    def __init__(self, k: int, temperature: float = 1.0) -> None:
+        if k < 1:
+            raise ValueError('k must be at least 1')
+        _check_temperature(temperature)
+        self.__k = k
+        self.__temperature = temperature
+
+    def sample(self, table: SamplingTable, rand: Random) -> Suffix:
+        table = ranked(table, self.__temperature)
+        n = min(self.__k, len(table.suffixes))
+        return _sample_first(table, n, rand)
+
+
+class NucleusSampler(Sampler):
+    """
+    Samples among the fewest most frequent suffixes whose probabilities add
+    up to at least p, after raising counts to 1 / temperature.
+    """
+
+    def __init__(self, p: float, temperature: float = 1.0) -> None:
+        if not 0 < p <= 1:
+            raise ValueError('p must be in (0, 1]')
+        _check_temperature(temperature)
+        self.__p = p
+        self.__temperature = temperature
+
+    def sample(self, table: SamplingTable, rand: Random) -> Suffix:
+        table = ranked(table, self.__temperature)
+        n = bisect_left(table.cum_weights, self.__p * table.total) + 1
+        return _sample_first(table, min(n, len(table.suffixes)), rand)
+
+
+class TemperatureSampler(Sampler):
+    """
+    Samples suffixes in proportion to their counts raised to 1 / temperature;
+    temperatures below 1 favour frequent suffixes, above 1 rare ones.
+    """
+
+    def __init__(self, temperature: float) -> None:
+        _check_temperature(temperature)
+        self.__temperature = temperature
+
+    def sample(self, table: SamplingTable, rand: Random) -> Suffix:
+        return ranked(table, self.__temperature).sample(rand)
+
+
+def ranked(table: SamplingTable, temperature: float) -> SamplingTable:
+    """
+    Return the table with its suffixes sorted by count, most frequent first,
+    weighted by their counts raised to 1 / temperature. The result is cached
+    on the table, so each prefix is sorted once per temperature.
+    """
+    return table.derive(('ranked', temperature),
+                        lambda t: _rank(t, temperature))
+
+
+def _rank(table: SamplingTable, temperature: float) -> SamplingTable:
+    counts = sorted(table.counts().items(), key=lambda e: e[1],
+                    reverse=True)
+
+    # Scale by the largest count first so low temperatures do not overflow.
+    exponent: Optional[float] = None if temperature == 1.0 \
+        else 1.0 / temperature
+    largest = counts[0][1]
+    cum_weights = []
+    total = 0.0
+    for _, count in counts:
+        total += count if exponent is None else (count / largest) ** exponent
+        cum_weights.append(total)
+    return SamplingTable(tuple(suffix for suffix, _ in counts),
+                         tuple(cum_weights))
+
+
+def _sample_first(table: SamplingTable, n: int, rand: Random) -> Suffix:
+    """
+    Sample from the first n suffixes of the table.
+    """
+    return table.suffixes[table.find(rand.random() * table.cum_weights[n - 1])]
+
+
+def _check_temperature(temperature: float) -> None:
+    if temperature <= 0:
+        raise ValueError('temperature must be positive')
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+from array import array
+from typing import Hashable, List
+
+
+class CountMinSketch:
+    """
+    Approximate counter over a fixed depth x width table of 32-bit counters.
+    Each key is counted in one counter per row, chosen by its hash, and its
+    estimate is the smallest of its counters. Estimates are never below the
+    true count; collisions can only raise them. Counters are only raised as
+    far as needed (conservative update), which keeps overestimates small.
+
+    Keys are hashed with hash(), so estimates are only comparable within one
+    process.
+    """
+
+    MAX_COUNT = 0xFFFFFFFF
+
+    def __init__(self, width: int, depth: int = 4) -> None:
+        if width < 1 or depth < 1:
+            raise ValueError('width and depth must be at least 1')
+        self.__width = width
+        self.__depth = depth
+        self.__table = array('I', bytes(4 * width * depth))
+        self.__offsets = [(row, row * width) for row in range(0, depth)]
+
+    @staticmethod
+    def for_memory(memory: int, depth: int = 4) -> CountMinSketch:
+        """
+        Return a sketch of the given depth using about memory bytes.
+        """
+        return CountMinSketch(max(1, memory // (4 * depth)), depth)
+
+    def add(self, key: Hashable) -> None:
+        table = self.__table
+        indices = self.__indices(key)
+        lowest = min([table[i] for i in indices])
+        if lowest == self.MAX_COUNT:
+            return
+        for i in indices:
+            if table[i] == lowest:
+                table[i] = lowest + 1
+
+    def estimate(self, key: Hashable) -> int:
+        table = self.__table
+        return min([table[i] for i in self.__indices(key)])
+
+    def memory(self) -> int:
+        return self.__table.itemsize * len(self.__table)
+
+    def __indices(self, key: Hashable) -> List[int]:
+        # Derive one index per row from the two halves of the hash.
+        h = hash(key)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32 & 0xFFFFFFFF) | 1
+        width = self.__width
+        return [offset + (h1 + row * h2) % width
+                for row, offset in self.__offsets]
@@ -0,0 +1,462 @@
+from __future__ import annotations
+
+import json
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import accumulate
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+from .chain import (Chain, ChainView, Prefix, SamplingTable, SizeGroup,
+                    SuffixData)
+from .vocab import Vocabulary
+
+
+# Sources that snapshots are read from: open files, or MappedChain's mapping.
+_Source = Union[BinaryIO, mmap.mmap]
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot:
+    """
+    Compact binary on-disk form of a chain. The chain's vocabulary is stored as
+    a single token table and every size group as packed integer arrays of
+    token IDs:
+
+        header     magic, version, metadata length, metadata (JSON)
+        tokens     count, byte length of each token, UTF-8 token blob, in
+                   ID order
+        groups     count, then for each group:
+                   state size, prefix count, suffix count,
+                   prefix keys   (prefix count * state size token indices),
+                   offsets       (prefix count + 1 indices into suffixes),
+                   suffixes      (token indices),
+                   counts
+
+    All integers are little-endian unsigned 32-bit and every section is padded
+    to a 4 byte boundary. Prefix keys are written in sorted order.
+    """
+
+    MAGIC = b'MKVC'
+    VERSION = 2
+
+    VOCAB_SEGMENT = 'vocab.snapshot'
+
+    def __init__(self, chain: Chain, metadata: Optional[Dict] = None) -> None:
+        self.chain = chain
+        self.metadata = metadata if metadata is not None else dict()
+
+    def write(self, f: BinaryIO) -> None:
+        groups = self.chain.inner()
+
+        _write_header(f, self.metadata)
+        _write_tokens(f, self.chain.vocab().tokens())
+
+        f.write(struct.pack('<I', len(groups)))
+        for state_size in sorted(groups):
+            _write_group(f, state_size, groups[state_size])
+
+    def write_segments(self, directory: Path) -> None:
+        """
+        Write the chain as one snapshot file per size group, for LazyChain.
+        VOCAB_SEGMENT holds the vocabulary and no groups, with the metadata
+        and the list of state sizes; each group file holds one group and no
+        tokens.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        groups = self.chain.inner()
+
+        metadata = dict(self.metadata)
+        metadata['state_sizes'] = sorted(groups)
+        with open(directory.joinpath(self.VOCAB_SEGMENT), 'wb') as f:
+            _write_header(f, metadata)
+            _write_tokens(f, self.chain.vocab().tokens())
+            f.write(struct.pack('<I', 0))
+
+        for state_size, group in groups.items():
+            path = directory.joinpath(_group_segment(state_size))
+            with open(path, 'wb') as f:
+                _write_header(f, {'state_size': state_size})
+                _write_tokens(f, [])
+                f.write(struct.pack('<I', 1))
+                _write_group(f, state_size, group)
+
+    @staticmethod
+    def read(f: BinaryIO) -> Snapshot:
+        metadata = _read_header(f)
+        tokens = _read_tokens(f)
+
+        chain = Chain(Vocabulary(tokens))
+        groups = chain.inner()
+
+        # Map through a shared list so that every prefix and suffix refers to
+        # the same int object for a given ID.
+        ids = list(range(0, len(tokens)))
+
+        group_count, = _read_struct(f, '<I')
+        for _ in range(0, group_count):
+            state_size, keys, offsets, suffix_ids, counts = _read_group(f)
+
+            group: SizeGroup = dict()
+            for i in range(0, len(offsets) - 1):
+                key_start = i * state_size
+                prefix = tuple(ids[t]
+                               for t in keys[key_start:key_start + state_size])
+                lo, hi = offsets[i], offsets[i + 1]
+                group[prefix] = {ids[s]: c for s, c in
+                                 zip(suffix_ids[lo:hi], counts[lo:hi])}
+            groups[state_size] = group
+
+        return Snapshot(chain, metadata)
+
+
+class MappedChain(ChainView):
+    """
+    Read-only chain backed by a memory-mapped snapshot file. Prefix keys,
+    offsets, suffixes and counts are read from the mapping on demand, so
+    processes mapping the same file share one copy through the page cache.
+    Only the vocabulary is loaded into memory.
+
+    Prefixes are found by binary search over the sorted keys of their size
+    group.
+    """
+
+    def __init__(self, path: str) -> None:
+        if sys.byteorder == 'big':
+            raise SnapshotError('Mapped snapshots need a little-endian host')
+
+        self.__path = path
+        with open(path, 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        mm = self.__mmap
+        self.metadata = _read_header(mm)
+        self.__vocab = Vocabulary(_read_tokens(mm))
+
+        self.__view = memoryview(mm)
+        self.__groups: Dict[int, _MappedGroup] = dict()
+        group_count, = _read_struct(mm, '<I')
+        for _ in range(0, group_count):
+            state_size, prefix_count, suffix_count = _read_struct(mm, '<III')
+            keys = self.__array_view(prefix_count * state_size)
+            offsets = self.__array_view(prefix_count + 1)
+            suffix_ids = self.__array_view(suffix_count)
+            counts = self.__array_view(suffix_count)
+            self.__groups[state_size] = _MappedGroup(
+                state_size, keys, offsets, suffix_ids, counts)
+
+    def prefixes(self, state_size: int) -> List[Prefix]:
+        group = self.__groups[state_size]
+        return [group.key(i) for i in range(0, len(group))]
+
+    def suffixes_of(self, prefix: Prefix) -> Optional[SuffixData]:
+        found = self.__find(prefix)
+        if found is None:
+            return None
+
+        group, i = found
+        lo, hi = group.offsets[i], group.offsets[i + 1]
+        return dict(zip(group.suffix_ids[lo:hi], group.counts[lo:hi]))
+
+    def state_sizes(self) -> List[int]:
+        return list(self.__groups.keys())
+
+    def vocab(self) -> Vocabulary:
+        return self.__vocab
+
+    def sampling_table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        found = self.__find(prefix)
+        if found is None:
+            return None
+
+        group, i = found
+        lo, hi = group.offsets[i], group.offsets[i + 1]
+        return SamplingTable(tuple(group.suffix_ids[lo:hi]),
+                             tuple(accumulate(group.counts[lo:hi])))
+
+    def close(self) -> None:
+        for group in self.__groups.values():
+            group.release()
+        self.__groups.clear()
+        self.__view.release()
+        self.__mmap.close()
+
+    def __reduce__(self) -> tuple:
+        # Map the file again rather than copying its contents when pickled,
+        # e.g. when handed to worker processes.
+        return MappedChain, (self.__path,)
+
+    def __enter__(self) -> MappedChain:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __find(self, prefix: Prefix) -> Optional[tuple]:
+        group = self.__groups.get(len(prefix))
+        if group is None:
+            return None
+
+        i = bisect_left(group, prefix)
+        if i == len(group) or group.key(i) != prefix:
+            return None
+        return group, i
+
+    def __array_view(self, n: int) -> memoryview:
+        start = self.__mmap.tell()
+        end = start + n * 4
+        if end > len(self.__mmap):
+            raise SnapshotError('Unexpected end of snapshot')
+        self.__mmap.seek(end)
+        return self.__view[start:end].cast('I')
+
+
+class LazyChain(ChainView):
+    """
+    Read-only chain over a directory written by Snapshot.write_segments. Only
+    the vocabulary is read up front; each size group is read from its segment
+    file the first time a prefix of that size is looked up, into sampling
+    tables as in FrozenChain.
+
+    If max_groups is given, at most that many groups are kept in memory and
+    the least recently used group is evicted to make room for another; it is
+    read again if it is needed later.
+    """
+
+    def __init__(self, directory: str,
+                 max_groups: Optional[int] = None) -> None:
+        self.__directory = Path(directory)
+        self.__max_groups = max_groups
+
+        with open(self.__directory.joinpath(Snapshot.VOCAB_SEGMENT),
+                  'rb') as f:
+            self.metadata = _read_header(f)
+            self.__vocab = Vocabulary(_read_tokens(f))
+        self.__state_sizes: List[int] = self.metadata.get('state_sizes', [])
+        self.__ids = list(range(0, len(self.__vocab)))
+
+        self.__groups: OrderedDict[int, Dict[Prefix, SamplingTable]] = \
+            OrderedDict()
+
+    def prefixes(self, state_size: int) -> List[Prefix]:
+        group = self.__group(state_size)
+        if group is None:
+            raise KeyError(state_size)
+        return list(group)
+
+    def suffixes_of(self, prefix: Prefix) -> Optional[SuffixData]:
+        table = self.sampling_table(prefix)
+        if table is None:
+            return None
+        return table.counts()
+
+    def state_sizes(self) -> List[int]:
+        return list(self.__state_sizes)
+
+    def vocab(self) -> Vocabulary:
+        return self.__vocab
+
+    def sampling_table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        group = self.__group(len(prefix))
+        if group is None:
+            return None
+        return group.get(prefix)
+
+    def loaded(self) -> List[int]:
+        """
+        Return the state sizes whose groups are in memory.
+        """
+        return list(self.__groups)
+
+    def evict(self, state_size: int) -> None:
+        self.__groups.pop(state_size, None)
+
+    def __reduce__(self) -> tuple:
+        # Workers read the groups they need themselves.
+        return LazyChain, (str(self.__directory), self.__max_groups)
+
+    def __group(self, state_size: int) \
+            -> Optional[Dict[Prefix, SamplingTable]]:
+        groups = self.__groups
+        group = groups.get(state_size)
+        if group is not None:
+            groups.move_to_end(state_size)
+            return group
+
+        if state_size not in self.__state_sizes:
+            return None
+
+        group = self.__read_group(state_size)
+        groups[state_size] = group
+        if self.__max_groups is not None:
+            while len(groups) > max(self.__max_groups, 1):
+                groups.popitem(last=False)
+        return group
+
+    def __read_group(self, state_size: int) -> Dict[Prefix, SamplingTable]:
+        path = self.__directory.joinpath(_group_segment(state_size))
+        with open(path, 'rb') as f:
+            _read_header(f)
+            _read_tokens(f)
+            group_count, = _read_struct(f, '<I')
+            if group_count != 1:
+                raise SnapshotError('Expected one group in {}'.format(path))
+            _, keys, offsets, suffix_ids, counts = _read_group(f)
+
+        ids = self.__ids
+        group = dict()
+        for i in range(0, len(offsets) - 1):
+            key_start = i * state_size
+            prefix = tuple(ids[t]
+                           for t in keys[key_start:key_start + state_size])
+            lo, hi = offsets[i], offsets[i + 1]
+            group[prefix] = SamplingTable(
+                tuple(ids[s] for s in suffix_ids[lo:hi]),
+                tuple(accumulate(counts[lo:hi])))
+        return group
+
+
+class _MappedGroup:
+    """
+    Sorted prefix keys of one state size, indexable as a sequence of prefix
+    tuples for bisection.
+    """
+
+    def __init__(self, state_size: int, keys: memoryview,
+                 offsets: memoryview, suffix_ids: memoryview,
+                 counts: memoryview) -> None:
+        self.state_size = state_size
+        self.keys = keys
+        self.offsets = offsets
+        self.suffix_ids = suffix_ids
+        self.counts = counts
+        self.__len = len(offsets) - 1
+
+    def key(self, i: int) -> Prefix:
+        n = self.state_size
+        return tuple(self.keys[i * n:(i + 1) * n])
+
+    def release(self) -> None:
+        for view in (self.keys, self.offsets, self.suffix_ids, self.counts):
+            view.release()
+
+    def __getitem__(self, i: int) -> Prefix:
+        return self.key(i)
+
+    def __len__(self) -> int:
+        return self.__len
+
+
+def _group_segment(state_size: int) -> str:
+    return 'group-{}.snapshot'.format(state_size)
+
+
+def _write_header(f: BinaryIO, metadata: Dict) -> None:
+    encoded = json.dumps(metadata).encode('utf-8')
+    f.write(Snapshot.MAGIC)
+    f.write(struct.pack('<II', Snapshot.VERSION, len(encoded)))
+    f.write(_padded(encoded))
+
+
+def _write_tokens(f: BinaryIO, tokens: List[str]) -> None:
+    encoded = [token.encode('utf-8') for token in tokens]
+    f.write(struct.pack('<I', len(encoded)))
+    _write_array(f, array('I', map(len, encoded)))
+    f.write(_padded(b''.join(encoded)))
+
+
+def _write_group(f: BinaryIO, state_size: int, group: SizeGroup) -> None:
+    keys = array('I')
+    offsets = array('I', [0])
+    suffix_ids = array('I')
+    counts = array('I')
+    for prefix in sorted(group):
+        suffixes = group[prefix]
+        keys.extend(prefix)
+        suffix_ids.extend(suffixes.keys())
+        counts.extend(suffixes.values())
+        offsets.append(len(suffix_ids))
+
+    f.write(struct.pack('<III', state_size, len(group), len(suffix_ids)))
+    for arr in (keys, offsets, suffix_ids, counts):
+        _write_array(f, arr)
+
+
+def _read_group(f: _Source) -> Tuple[int, array, array, array, array]:
+    """
+    Return the state size, keys, offsets, suffixes and counts of a group.
+    """
+    state_size, prefix_count, suffix_count = _read_struct(f, '<III')
+    keys = _read_array(f, prefix_count * state_size)
+    offsets = _read_array(f, prefix_count + 1)
+    suffix_ids = _read_array(f, suffix_count)
+    counts = _read_array(f, suffix_count)
+    return state_size, keys, offsets, suffix_ids, counts
+
+
+def _read_header(f: _Source) -> Dict:
+    if f.read(4) != Snapshot.MAGIC:
+        raise SnapshotError('Not a chain snapshot')
+
+    version, metadata_len = _read_struct(f, '<II')
+    if version != Snapshot.VERSION:
+        raise SnapshotError(
+            'Unsupported snapshot version: {}'.format(version))
+    return json.loads(_read_padded(f, metadata_len).decode('utf-8'))
+
+
+def _read_tokens(f: _Source) -> List[str]:
+    token_count, = _read_struct(f, '<I')
+    lengths = _read_array(f, token_count)
+    blob = _read_padded(f, sum(lengths))
+
+    tokens: List[str] = []
+    start = 0
+    for length in lengths:
+        tokens.append(blob[start:start + length].decode('utf-8'))
+        start += length
+    return tokens
+
+
+def _padded(data: bytes) -> bytes:
+    return data + b'\0' * (-len(data) % 4)
+
+
+def _read_padded(f: _Source, n: int) -> bytes:
+    data = f.read(n + (-n % 4))
+    if len(data) < n:
+        raise SnapshotError('Unexpected end of snapshot')
+    return data[:n]
+
+
+def _read_struct(f: _Source, fmt: str) -> tuple:
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) < size:
+        raise SnapshotError('Unexpected end of snapshot')
+    return struct.unpack(fmt, data)
+
+
+def _write_array(f: BinaryIO, arr: array) -> None:
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    f.write(arr.tobytes())
+
+
+def _read_array(f: _Source, n: int) -> array:
+    arr = array('I')
+    data = f.read(n * arr.itemsize)
+    if len(data) < n * arr.itemsize:
+        raise SnapshotError('Unexpected end of snapshot')
+    arr.frombytes(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
@@ -1,22 +1,21 @@
 import re
-from io import TextIOWrapper
-from typing import Iterator
+from typing import Iterable, Iterator
 
 from .chain import Text
 
 
 class FileText(Text):
     """
-    Text implementation for a file handle. The constructor can be considered a
-    non-moving pass of the file object; this class does not resource manage the
-    file.
+    Text implementation for a file handle, or any other iterable of lines. The
+    constructor can be considered a non-moving pass of the file object; this
+    class does not resource manage the file.
     """
 
     CLEANERS = [
         (re.compile(r'“|”|‟'), '"'),
     ]
 
-    def __init__(self, f: TextIOWrapper) -> None:
+    def __init__(self, f: Iterable[str]) -> None:
         self.__inner = f
 
     def lines(self) -> Iterator[str]:
@@ -1,18 +1,75 @@
+from __future__ import annotations
+
 import re
-from typing import List
+from collections import OrderedDict
+from typing import List, Tuple
 
 
 class Tokenizer:
-    def __init__(self) -> None:
-        self.__tokenizer = _Tokenizer()
+    """
+    Tokenizer and detokenizer pair. By default tokenization uses the
+    single-pass engine; single_pass=False selects the multi-pass reference
+    implementation, whose output also contains empty strings left over from
+    padding. Both produce the same non-empty tokens.
+
+    If cache_size is positive, the results for the cache_size most recently
+    tokenized texts are kept, so repeated lines are tokenized once.
+    """
+
+    def __init__(self, single_pass: bool = True, cache_size: int = 0) -> None:
+        self.__tokenizer = _ScanTokenizer() if single_pass else _Tokenizer()
         self.__detokenizer = _Detokenizer()
 
+        self.__cache: OrderedDict[str, Tuple[str, ...]] = OrderedDict()
+        self.__cache_info = CacheInfo(cache_size)
+
     def tokenize(self, text: str) -> List[str]:
-        return self.__tokenizer.tokenize(text)
+        info = self.__cache_info
+        if info.max_size <= 0:
+            return self.__tokenizer.tokenize(text)
+
+        cache = self.__cache
+        tokens = cache.get(text)
+        if tokens is not None:
+            cache.move_to_end(text)
+            info.hits += 1
+            return list(tokens)
+
+        info.misses += 1
+        result = self.__tokenizer.tokenize(text)
+        cache[text] = tuple(result)
+        if len(cache) > info.max_size:
+            cache.popitem(last=False)
+        return result
 
     def detokenize(self, tokens: List[str]) -> str:
         return self.__detokenizer.detokenize(tokens)
 
+    def cache_info(self) -> CacheInfo:
+        self.__cache_info.size = len(self.__cache)
+        return self.__cache_info
+
+    def cache_clear(self) -> None:
+        self.__cache.clear()
+        self.__cache_info.hits = 0
+        self.__cache_info.misses = 0
+
+
+class CacheInfo:
+    """
+    Hit and miss counts of a tokenizer's cache.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.max_size = max_size
+
+    def __str__(self) -> str:
+        return 'hits={}, misses={}, size={}/{}'.format(
+            self.hits, self.misses, self.size, self.max_size)
+
 
 class _Tokenizer:
     """
@@ -69,6 +126,76 @@ class _Tokenizer:
         return text.split(' ')
 
 
+class _ScanTokenizer:
+    """
+    Single-pass equivalent of _Tokenizer. Tokens are matched in one scan by a
+    combined pattern; every alternative corresponds to a padding rule of the
+    reference passes, and the word alternatives match runs that no rule
+    splits. Double quotes are converted by their position, as by the
+    STARTING_QUOTES and ENDING_QUOTES rules.
+
+    Lines whose result depends on the order of the reference passes (backticks,
+    single quotes not followed by a word character, runs of colons and commas,
+    whitespace other than spaces) are handed to the reference implementation.
+    Empty tokens are never returned.
+    """
+
+    # Characters that no rule pads or splits on.
+    PLAIN = r'[^\ ;@#$%&?!\[\](){}<>".:,-]'
+
+    # Characters that stay inside a word: a period that does not start an
+    # ellipsis and is not the final period, or follows another period; a
+    # single dash; a colon or comma before a digit.
+    GLUE = r"""(?:
+            (?<=\.)\.
+          | (?<!\.)(?!\.\.\.)(?!(?<=[\s\S])\.[\]\)}>"]*\ *$)\.
+          | -(?!-)
+          | [:,](?=\d)
+        )"""
+
+    SCAN = re.compile(r"""
+        {plain}+ (?: {glue} {plain}* )*           # word
+      | \.\.\.                                    # ellipsis
+      | --                                       # double dash
+      | [;@#$%&?!\[\](){{}}<>"]                    # padded characters
+      | [:,](?!\d)                               # colon or comma
+      | (?<=[\s\S])\.(?=[\]\)}}>"]*\ *$)            # final period
+      | (?: {glue} {plain}* )+                   # word starting with glue
+    """.format(plain=PLAIN, glue=GLUE), re.VERBOSE)
+
+    FALLBACK = re.compile(r"`|'(?!\w)|[:,][:,]|[^\S ]")
+
+    OPENERS = ' ([{<'
+
+    def __init__(self) -> None:
+        self.__reference = _Tokenizer()
+
+    def tokenize(self, text: str) -> List[str]:
+        if self.FALLBACK.search(text) is not None:
+            return [t for t in self.__reference.tokenize(text) if t != '']
+
+        if '"' not in text:
+            return self.SCAN.findall(text)
+
+        tokens = []
+        for match in self.SCAN.finditer(text):
+            token = match.group()
+            if token == '"':
+                token = '``' if self.__is_opening(text, match.start()) \
+                    else "''"
+            tokens.append(token)
+        return tokens
+
+    def __is_opening(self, text: str, i: int) -> bool:
+        if i == 0:
+            return True
+        if text[i - 1] in self.OPENERS:
+            return True
+        # A quote at the start is padded before opening quotes are found, so
+        # a quote directly after it also opens.
+        return i == 1 and text[0] == '"'
+
+
 class _Detokenizer:
     ENDING_QUOTES = [
         (re.compile(r"([^' ])\s('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1\2 "),
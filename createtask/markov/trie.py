@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+from typing import Any, Iterator, List, Optional, Sequence, Set, Tuple
+
+from .chain import (Chain, ChainStore, Prefix, SamplingTable, Suffix,
+                    SuffixData)
+from .vocab import Vocabulary
+
+# A trie node is a [counts, children] pair: the counts of its suffix IDs, and
+# the child node of each token ID, or None until it has children.
+_Node = List[Any]
+
+
+class TrieChain(ChainStore):
+    """
+    Chain stored as a trie of prefixes read from their last token backwards.
+    The node of a prefix is the child of the node of the prefix without its
+    first token, so prefixes of every state size share their nodes and no
+    prefix tuples are stored. Each node keeps its suffix counts apart from its
+    children, so looking up a prefix walks down one node per token and
+    returns its counts as they are. The root holds the start tokens.
+
+    insert_history counts a suffix for every state size in one walk down the
+    trie. Use to_chain to convert to a Chain for merging or snapshots.
+    """
+
+    def __init__(self, vocab: Optional[Vocabulary] = None) -> None:
+        self.__root: _Node = [dict(), None]
+        self.__vocab = vocab if vocab is not None else Vocabulary()
+        self.__state_sizes: Set[int] = set()
+
+    def prefixes(self, state_size: int) -> List[Prefix]:
+        if state_size not in self.__state_sizes:
+            raise KeyError(state_size)
+        return [prefix for prefix, _ in self.__walk(state_size)]
+
+    def suffixes_of(self, prefix: Prefix) -> Optional[SuffixData]:
+        node: _Node = self.__root
+        for token in reversed(prefix):
+            children = node[1]
+            if children is None:
+                return None
+            child: Optional[_Node] = children.get(token)
+            if child is None:
+                return None
+            node = child
+        return node[0] if len(node[0]) != 0 else None
+
+    def vocab(self) -> Vocabulary:
+        return self.__vocab
+
+    def sampling_table(self, prefix: Prefix) -> Optional[SamplingTable]:
+        suffixes = self.suffixes_of(prefix)
+        if suffixes is None:
+            return None
+        return SamplingTable.from_counts(suffixes)
+
+    def state_sizes(self) -> List[int]:
+        return sorted(self.__state_sizes)
+
+    def insert(self, prefix: Prefix, suffix: Suffix) -> None:
+        if suffix < 0 or any(token < 0 for token in prefix):
+            raise ValueError('Token IDs must not be negative')
+        node = self.__root
+        for token in reversed(prefix):
+            node = _child(node, token)
+        counts = node[0]
+        counts[suffix] = counts.get(suffix, 0) + 1
+        self.__state_sizes.add(len(prefix))
+
+    def insert_history(self, history: Sequence[Suffix],
+                       suffix: Suffix) -> None:
+        node = self.__root
+        if len(history) == 0:
+            counts = node[0]
+            counts[suffix] = counts.get(suffix, 0) + 1
+            self.__state_sizes.add(0)
+            return
+
+        for i in range(len(history) - 1, -1, -1):
+            children = node[1]
+            if children is None:
+                children = node[1] = dict()
+            child = children.get(history[i])
+            if child is None:
+                child = children[history[i]] = [{suffix: 1}, None]
+            else:
+                counts = child[0]
+                if suffix in counts:
+                    counts[suffix] += 1
+                else:
+                    counts[suffix] = 1
+            node = child
+        if len(history) not in self.__state_sizes:
+            self.__state_sizes.update(range(1, len(history) + 1))
+
+    def to_chain(self) -> Chain:
+        chain = Chain(self.__vocab)
+        groups = chain.inner()
+        for state_size in self.state_sizes():
+            groups[state_size] = {prefix: dict(suffixes) for prefix, suffixes
+                                  in self.__walk(state_size)}
+        return chain
+
+    def __len__(self) -> int:
+        return sum(1 for state_size in self.__state_sizes
+                   for _ in self.__walk(state_size))
+
+    def __walk(self, state_size: int) -> Iterator[Tuple[Prefix, SuffixData]]:
+        """
+        Yield every prefix of the state size that has suffixes, with its
+        suffix counts.
+        """
+        stack: List[Tuple[_Node, Prefix]] = [(self.__root, ())]
+        while len(stack) != 0:
+            node, prefix = stack.pop()
+            if len(prefix) == state_size:
+                if len(node[0]) != 0:
+                    yield prefix, node[0]
+                continue
+
+            if node[1] is not None:
+                for token, child in node[1].items():
+                    stack.append((child, (token, *prefix)))
+
+
+def _child(node: _Node, token: Suffix) -> _Node:
+    children = node[1]
+    if children is None:
+        children = node[1] = dict()
+    child = children.get(token)
+    if child is None:
+        child = children[token] = [dict(), None]
+    return child
@@ -0,0 +1,58 @@
+from typing import Dict, Iterable, List, Tuple
+
+
+class Vocabulary:
+    """
+    Bidirectional mapping between tokens and dense integer IDs. IDs are
+    assigned in order of first insertion, starting at 0.
+    """
+
+    UNKNOWN = -1
+
+    def __init__(self, tokens: Iterable[str] = ()) -> None:
+        self.__ids: Dict[str, int] = dict()
+        self.__tokens: List[str] = []
+
+        for token in tokens:
+            self.intern(token)
+
+    def intern(self, token: str) -> int:
+        """
+        Return the ID of the token, assigning a new one if it has not been seen
+        before.
+        """
+        token_id = self.__ids.get(token)
+        if token_id is None:
+            token_id = len(self.__tokens)
+            self.__ids[token] = token_id
+            self.__tokens.append(token)
+        return token_id
+
+    def id_of(self, token: str) -> int:
+        """
+        Return the ID of the token, or UNKNOWN if it has not been interned.
+        """
+        return self.__ids.get(token, self.UNKNOWN)
+
+    def token(self, token_id: int) -> str:
+        return self.__tokens[token_id]
+
+    def encode(self, tokens: Iterable[str]) -> Tuple[int, ...]:
+        """
+        Map tokens to IDs without interning; unseen tokens become UNKNOWN.
+        """
+        ids = self.__ids
+        return tuple(ids.get(token, self.UNKNOWN) for token in tokens)
+
+    def decode(self, token_ids: Iterable[int]) -> List[str]:
+        tokens = self.__tokens
+        return [tokens[token_id] for token_id in token_ids]
+
+    def tokens(self) -> List[str]:
+        return list(self.__tokens)
+
+    def __len__(self) -> int:
+        return len(self.__tokens)
+
+    def __contains__(self, token: str) -> bool:
+        return token in self.__ids
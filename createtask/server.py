@@ -0,0 +1,326 @@
+"""
+Local HTTP server for sentence completion.
+
+    python -m createtask.server [--host HOST] [--port PORT] [--processes N]
+                                [--reachability]
+
+POST /complete with a JSON body {"prompt": "...", "n": 1} returns
+{"completions": [...]}, each completion being the prompt followed by a
+generated sentence. GET /health returns {"status": "ok"}.
+
+The chain is loaded once and mapped by every worker process. Requests that
+arrive within a short window are batched and completed together on the
+worker pool, so the event loop only parses requests and writes responses.
+With --reachability, every worker also builds a backoff model and its
+Reachability, so completions avoid contexts that cannot reach a sentence
+ending; this copies the chain into each worker's private memory.
+"""
+
+import asyncio
+import json
+import os
+import time
+import traceback
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from random import Random
+from typing import Dict, List, Optional, Tuple
+
+from .loader import (GENERATION_TIMEOUT, MAX_TOKENS, TOKENIZER_CACHE_SIZE,
+                     load_chain, snapshot_filepath)
+from .markov import (BackoffModel, ChainView, Completer, MappedChain,
+                     Reachability)
+from .markov.tokenize import Tokenizer
+
+MAX_BODY_SIZE = 64 * 1024
+MAX_N = 100
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Batcher:
+    """
+    Collects completion requests and hands them to the worker pool in batches
+    of about max_batch prompts, waiting at most window seconds after the first
+    request of a batch for more to arrive. Each batch is completed by one
+    worker with Completer.generate_batch; batches run concurrently across the
+    pool. Each completion is cut off at max_tokens tokens, and a batch stops
+    generating timeout seconds after a worker starts it.
+    """
+
+    def __init__(self, executor: ProcessPoolExecutor, window: float,
+                 max_batch: int, max_pending: int, seed: int,
+                 max_tokens: int, timeout: float) -> None:
+        self.__executor = executor
+        self.__window = window
+        self.__max_batch = max_batch
+        self.__max_pending = max_pending
+        self.__rand = Random(seed)
+        self.__max_tokens = max_tokens
+        self.__timeout = timeout
+
+        self.__queue: asyncio.Queue = asyncio.Queue()
+        self.__pending = 0
+
+    async def complete(self, prompt: str, n: int) -> List[str]:
+        if self.__pending + n > self.__max_pending:
+            raise HTTPError(503, 'Too many pending requests')
+
+        future = asyncio.get_running_loop().create_future()
+        self.__pending += n
+        try:
+            self.__queue.put_nowait((prompt, n, future))
+            return await future
+        finally:
+            self.__pending -= n
+
+    async def run(self) -> None:
+        tasks = set()
+        while True:
+            requests = await self.__collect()
+            task = asyncio.create_task(self.__dispatch(requests))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def __dispatch(self,
+                         requests: List[Tuple[str, int, asyncio.Future]]) \
+            -> None:
+        prompts = [prompt for prompt, n, _ in requests for _ in range(0, n)]
+        seed = self.__rand.getrandbits(64)
+        try:
+            completions = await asyncio.get_running_loop().run_in_executor(
+                self.__executor, _complete_batch, prompts, seed,
+                self.__max_tokens, self.__timeout)
+        except Exception as e:
+            for _, _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for _, n, future in requests:
+            if not future.done():
+                future.set_result(completions[start:start + n])
+            start += n
+
+    async def __collect(self) -> List[Tuple[str, int, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+
+        requests = [await self.__queue.get()]
+        size = requests[0][1]
+        deadline = loop.time() + self.__window
+        while size < self.__max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.__queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            requests.append(request)
+            size += request[1]
+
+        return requests
+
+
+class Server:
+    def __init__(self, batcher: Batcher) -> None:
+        self.__batcher = batcher
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+
+                method, path, headers, body = request
+                try:
+                    status, payload = await self.__route(method, path, body)
+                except HTTPError as e:
+                    status, payload = e.status, {'error': e.message}
+                except Exception:
+                    # A broken pool or an error raised in a worker.
+                    traceback.print_exc()
+                    status, payload = 500, {'error': 'Internal server error'}
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                _write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except HTTPError as e:
+            _write_response(writer, e.status, {'error': e.message}, False)
+        finally:
+            writer.close()
+
+    async def __route(self, method: str, path: str,
+                      body: bytes) -> Tuple[int, Dict]:
+        if path == '/health':
+            if method != 'GET':
+                raise HTTPError(405, 'Method not allowed')
+            return 200, {'status': 'ok'}
+
+        if path == '/complete':
+            if method != 'POST':
+                raise HTTPError(405, 'Method not allowed')
+            prompt, n = _parse_completion(body)
+            completions = await self.__batcher.complete(prompt, n)
+            return 200, {'completions': completions}
+
+        raise HTTPError(404, 'Not found')
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Serve sentence completions.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-window', type=float, default=5.0,
+                        help='milliseconds to wait for a batch to fill')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-pending', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--max-tokens', type=int, default=MAX_TOKENS,
+                        help='maximum tokens per completion')
+    parser.add_argument('--timeout', type=float, default=GENERATION_TIMEOUT,
+                        help='seconds a worker may spend on a batch')
+    parser.add_argument('--reachability', action='store_true',
+                        help='avoid contexts that cannot reach an ending')
+    args = parser.parse_args()
+
+    # Build or refresh the snapshot, then let every worker map it.
+    load_chain()
+    chain = MappedChain(str(snapshot_filepath()))
+
+    try:
+        asyncio.run(serve(chain, args))
+    except KeyboardInterrupt:
+        pass
+
+
+async def serve(chain: ChainView, args) -> None:
+    seed = args.seed if args.seed is not None else Random().getrandbits(64)
+    with ProcessPoolExecutor(args.processes, initializer=_init_worker,
+                             initargs=(chain, args.reachability)) as executor:
+        batcher = Batcher(executor, args.batch_window / 1000, args.max_batch,
+                          args.max_pending, seed, args.max_tokens,
+                          args.timeout)
+        server = Server(batcher)
+
+        batch_task = asyncio.create_task(batcher.run())
+        tcp_server = await asyncio.start_server(server.handle, args.host,
+                                                args.port)
+        print('Serving on http://{}:{}'.format(args.host, args.port))
+        try:
+            async with tcp_server:
+                await tcp_server.serve_forever()
+        finally:
+            batch_task.cancel()
+
+
+async def _read_request(reader: asyncio.StreamReader) \
+        -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    request_line = await reader.readline()
+    if len(request_line) == 0:
+        return None
+
+    try:
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, 'Malformed request line')
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', '0'))
+    except ValueError:
+        raise HTTPError(400, 'Invalid Content-Length')
+    if length < 0 or length > MAX_BODY_SIZE:
+        raise HTTPError(413, 'Request body too large')
+
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, path.split('?', 1)[0], headers, body
+
+
+def _parse_completion(body: bytes) -> Tuple[str, int]:
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise HTTPError(400, 'Body must be JSON')
+    if not isinstance(data, dict):
+        raise HTTPError(400, 'Body must be a JSON object')
+
+    prompt = data.get('prompt', '')
+    n = data.get('n', 1)
+    if not isinstance(prompt, str):
+        raise HTTPError(400, 'prompt must be a string')
+    if not isinstance(n, int) or isinstance(n, bool) or n < 1 or n > MAX_N:
+        raise HTTPError(400, 'n must be an integer from 1 to {}'.format(MAX_N))
+    return prompt, n
+
+
+def _write_response(writer: asyncio.StreamWriter, status: int,
+                    payload: Dict, keep_alive: bool) -> None:
+    body = json.dumps(payload).encode('utf-8')
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+              405: 'Method Not Allowed', 413: 'Payload Too Large',
+              500: 'Internal Server Error',
+              503: 'Service Unavailable'}.get(status, '')
+    head = ('HTTP/1.1 {} {}\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: {}\r\n'
+            'Connection: {}\r\n\r\n').format(
+        status, reason, len(body), 'keep-alive' if keep_alive else 'close')
+    writer.write(head.encode('latin-1') + body)
+
+
+_worker_chain: Optional[ChainView] = None
+_worker_completer: Optional[Completer] = None
+_worker_tokenizer: Optional[Tokenizer] = None
+
+
+def _init_worker(chain: ChainView, prune: bool) -> None:
+    global _worker_chain, _worker_completer, _worker_tokenizer
+    _worker_chain = chain
+    reachability = None
+    if prune:
+        reachability = Reachability(BackoffModel(chain), Completer.ENDINGS)
+    _worker_completer = Completer(chain, reachability=reachability)
+    _worker_tokenizer = Tokenizer(cache_size=TOKENIZER_CACHE_SIZE)
+
+
+def _complete_batch(prompts: List[str], seed: int, max_tokens: int,
+                    timeout: float) -> List[str]:
+    chain = _worker_chain
+    completer, tokenizer = _worker_completer, _worker_tokenizer
+    assert chain is not None
+    assert completer is not None and tokenizer is not None
+
+    vocab = chain.vocab()
+    tokenized = [tokenizer.tokenize(prompt.strip()) for prompt in prompts]
+    prefixes = [vocab.encode(tokens) for tokens in tokenized]
+
+    results = completer.generate_batch(
+        prefixes, 1, seed=seed, max_tokens=max_tokens,
+        deadline=time.monotonic() + timeout)
+    return [tokenizer.detokenize([*tokens, *vocab.decode(completions[0])])
+            for tokens, completions in zip(tokenized, results)]
+
+
+if __name__ == '__main__':
+    main()